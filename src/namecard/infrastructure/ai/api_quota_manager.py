@@ -6,10 +6,11 @@
 import asyncio
 import json
 import time
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+from typing import Deque, Dict, Optional, Tuple
 
 import aiofiles
 
@@ -52,7 +53,7 @@ class ApiKeyMetrics:
     # 錯誤追蹤
     consecutive_errors: int = 0
     last_error: Optional[str] = None
-    error_history: List[str] = field(default_factory=list)
+    error_history: Deque[str] = field(default_factory=lambda: deque(maxlen=10))
 
     def __post_init__(self):
         if self.quota_reset_time is None:
@@ -220,10 +221,8 @@ class ApiQuotaManager:
             metrics.consecutive_errors += 1
             metrics.last_error = error_message or "Unknown error"
 
-            # 記錄錯誤歷史（保留最近10個）
+            # 記錄錯誤歷史（deque 自動保留最近10個）
             metrics.error_history.append(f"{now.isoformat()}: {error_message}")
-            if len(metrics.error_history) > 10:
-                metrics.error_history.pop(0)
 
             # 根據錯誤類型更新狀態
             if error_message:
@@ -375,7 +374,8 @@ class ApiQuotaManager:
                     "average_response_time": metrics.average_response_time,
                     "consecutive_errors": metrics.consecutive_errors,
                     "last_error": metrics.last_error,
-                    "error_history": metrics.error_history[-5:],  # 只儲存最近5個錯誤
+                    # 只儲存最近5個錯誤
+                    "error_history": list(metrics.error_history)[-5:],
                     "last_used": (
                         metrics.last_used.isoformat() if metrics.last_used else None
                     ),
@@ -416,7 +416,9 @@ class ApiQuotaManager:
                     )
                     metrics.consecutive_errors = saved_data.get("consecutive_errors", 0)
                     metrics.last_error = saved_data.get("last_error")
-                    metrics.error_history = saved_data.get("error_history", [])
+                    metrics.error_history = deque(
+                        saved_data.get("error_history", []), maxlen=10
+                    )
 
                     # 恢復時間資料
                     if saved_data.get("last_used"):
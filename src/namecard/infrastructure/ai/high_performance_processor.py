@@ -20,7 +20,7 @@ import json
 import logging
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -60,9 +60,47 @@ class ImageMetadata:
     processing_hints: List[str] = field(default_factory=list)
 
 
+def _optimize_image_bytes(
+    image_bytes: bytes,
+    processing_hints: Tuple[str, ...],
+    max_image_size: Tuple[int, int],
+) -> bytes:
+    """圖片優化（模組層級函數，可在子進程中執行）"""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+
+        # 根據元數據選擇優化策略
+        if "large_image" in processing_hints:
+            # 大圖片：調整大小
+            img.thumbnail(max_image_size, Image.Resampling.LANCZOS)
+
+        if "low_quality" in processing_hints:
+            # 低品質：增強對比度
+            from PIL import ImageEnhance
+
+            enhancer = ImageEnhance.Contrast(img)
+            img = enhancer.enhance(1.2)
+
+        # 轉換為 RGB 格式（Gemini 最佳相容性）
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        # 輸出優化後的圖片
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=85, optimize=True)
+        return output.getvalue()
+
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"圖片優化失敗: {e}")
+        return image_bytes  # 返回原圖
+
+
 class SmartCache:
     """智能多層快取系統"""
 
+    # 超過此大小的圖片改在執行緒中計算雜湊（hashlib 對大輸入會釋放 GIL）
+    HASH_OFFLOAD_THRESHOLD = 64 * 1024
+
     def __init__(self, memory_size: int = 100, disk_size: int = 1000):
         self.logger = logging.getLogger(__name__)
 
@@ -91,10 +129,18 @@ class SmartCache:
         size_info = str(len(image_bytes))
         return f"{content_hash}_{size_info}"
 
+    async def _generate_cache_key_async(self, image_bytes: bytes) -> str:
+        """生成快取鍵（大圖片的雜湊移出事件循環）"""
+        if len(image_bytes) < self.HASH_OFFLOAD_THRESHOLD:
+            return self._generate_cache_key(image_bytes)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._generate_cache_key, image_bytes)
+
     async def get_cached_result(self, image_bytes: bytes) -> Optional[Dict[str, Any]]:
         """獲取快取結果"""
         self.stats["total_requests"] += 1
-        cache_key = self._generate_cache_key(image_bytes)
+        cache_key = await self._generate_cache_key_async(image_bytes)
 
         # L1: 記憶體快取檢查
         if cache_key in self.memory_cache:
@@ -127,7 +173,7 @@ class SmartCache:
 
     async def store_result(self, image_bytes: bytes, result: Dict[str, Any]):
         """存儲結果到快取"""
-        cache_key = self._generate_cache_key(image_bytes)
+        cache_key = await self._generate_cache_key_async(image_bytes)
 
         # 存儲到記憶體快取
         self._store_memory_cache(cache_key, result)
@@ -162,7 +208,10 @@ class SmartCache:
             }
 
             async with aiofiles.open(cache_file, "w", encoding="utf-8") as f:
-                await f.write(json.dumps(cache_data, ensure_ascii=False, indent=2))
+                # 快取檔僅供程式讀取，不縮排以保留 C 編碼器快速路徑
+                await f.write(
+                    json.dumps(cache_data, ensure_ascii=False, separators=(",", ":"))
+                )
 
             self.logger.debug(f"💾 已存儲磁碟快取: {cache_key[:12]}")
 
@@ -325,8 +374,19 @@ class HighPerformanceCardProcessor:
         self.supported_formats = {"JPEG", "PNG", "WebP"}
         self.max_file_size = 10 * 1024 * 1024  # 10MB
 
+        # 進程池（圖片解碼/縮放/編碼，懶加載，繞過 GIL 跨核心並行）
+        self.cpu_pool = None
+
         self.logger.info("✅ 處理管道初始化完成")
 
+    def _get_cpu_pool(self) -> ProcessPoolExecutor:
+        """獲取圖片處理進程池（懶加載）"""
+        if self.cpu_pool is None:
+            self.cpu_pool = ProcessPoolExecutor(
+                max_workers=max(1, (os.cpu_count() or 2) // 2)
+            )
+        return self.cpu_pool
+
     async def _get_http_session(self) -> aiohttp.ClientSession:
         """獲取 HTTP 會話（懶加載 + 連接池優化）"""
         if self.http_session is None:
@@ -427,38 +487,23 @@ class HighPerformanceCardProcessor:
         self, image_bytes: bytes, metadata: ImageMetadata
     ) -> bytes:
         """異步優化圖片以提升 AI 處理速度"""
+        # CPU 密集的圖片處理交給進程池，多張圖片可跨核心並行
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_cpu_pool(),
+            _optimize_image_bytes,
+            image_bytes,
+            tuple(metadata.processing_hints),
+            self.max_image_size,
+        )
 
-        def _optimize_sync():
-            try:
-                img = Image.open(io.BytesIO(image_bytes))
-
-                # 根據元數據選擇優化策略
-                if "large_image" in metadata.processing_hints:
-                    # 大圖片：調整大小
-                    img.thumbnail(self.max_image_size, Image.Resampling.LANCZOS)
-
-                if "low_quality" in metadata.processing_hints:
-                    # 低品質：增強對比度
-                    from PIL import ImageEnhance
-
-                    enhancer = ImageEnhance.Contrast(img)
-                    img = enhancer.enhance(1.2)
-
-                # 轉換為 RGB 格式（Gemini 最佳相容性）
-                if img.mode != "RGB":
-                    img = img.convert("RGB")
-
-                # 輸出優化後的圖片
-                output = io.BytesIO()
-                img.save(output, format="JPEG", quality=85, optimize=True)
-                return output.getvalue()
-
-            except Exception as e:
-                self.logger.warning(f"圖片優化失敗: {e}")
-                return image_bytes  # 返回原圖
+    async def _optimize_image_for_ai_async(self, image_bytes: bytes) -> bytes:
+        """批次預處理：分析元數據後優化圖片"""
+        metadata = await self.analyze_image_metadata(image_bytes)
+        if not metadata.is_valid:
+            return image_bytes
 
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.thread_pool, _optimize_sync)
+        return await self.optimize_image_for_ai(image_bytes, metadata)
 
     async def _call_gemini_api_async(
         self, image_bytes: bytes, prompt: str, max_retries: int = 3
@@ -519,7 +564,8 @@ class HighPerformanceCardProcessor:
         self, image_bytes: bytes, enable_cache: bool = True
     ) -> ProcessingResult:
         """高速處理單張名片"""
-        start_time = time.time()
+        # 耗時統一以單調的 perf_counter 計算，不受系統時鐘調整影響
+        start_time = time.perf_counter()
         optimizations = []
 
         try:
@@ -528,7 +574,7 @@ class HighPerformanceCardProcessor:
             if enable_cache:
                 cached_result = await self.cache.get_cached_result(image_bytes)
                 if cached_result:
-                    processing_time = time.time() - start_time
+                    processing_time = time.perf_counter() - start_time
                     self.processing_stats["cache_hits"] += 1
                     optimizations.append("cache_hit")
 
@@ -555,7 +601,7 @@ class HighPerformanceCardProcessor:
                 return ProcessingResult(
                     success=False,
                     error="圖片品質不佳，請重新拍攝",
-                    processing_time=time.time() - start_time,
+                    processing_time=time.perf_counter() - start_time,
                     optimizations_applied=optimizations,
                 )
 
@@ -572,9 +618,9 @@ class HighPerformanceCardProcessor:
                 optimizations.append("image_optimized")
 
             # 步驟 4: AI 處理 (2-8s，優化後)
-            ai_start = time.time()
+            ai_start = time.perf_counter()
             raw_response = await self._call_gemini_api_async(optimized_image, prompt)
-            ai_time = time.time() - ai_start
+            ai_time = time.perf_counter() - ai_start
 
             optimizations.append(f"ai_processing_{ai_time:.1f}s")
 
@@ -601,7 +647,7 @@ class HighPerformanceCardProcessor:
                 await self.cache.store_result(image_bytes, parsed_data)
 
             # 統計更新
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
             self.processing_stats["total_processed"] += 1
             self._update_avg_processing_time(processing_time)
 
@@ -614,7 +660,7 @@ class HighPerformanceCardProcessor:
             )
 
         except Exception as e:
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
             self.logger.error(f"高速處理失敗: {e}")
 
             return ProcessingResult(
@@ -674,7 +720,7 @@ class HighPerformanceCardProcessor:
     ) -> ProcessingResult:
         """高速處理多張名片"""
         # 使用多名片檢測 Prompt
-        start_time = time.time()
+        start_time = time.perf_counter()
 
         try:
             # 檢查快取
@@ -684,7 +730,7 @@ class HighPerformanceCardProcessor:
                     return ProcessingResult(
                         success=True,
                         data=cached_result,
-                        processing_time=time.time() - start_time,
+                        processing_time=time.perf_counter() - start_time,
                         cache_hit=True,
                         optimizations_applied=["cache_hit", "multi_card"],
                     )
@@ -695,7 +741,7 @@ class HighPerformanceCardProcessor:
                 return ProcessingResult(
                     success=False,
                     error="圖片品質不佳",
-                    processing_time=time.time() - start_time,
+                    processing_time=time.perf_counter() - start_time,
                     optimizations_applied=["fast_failure", "multi_card"],
                 )
 
@@ -711,7 +757,7 @@ class HighPerformanceCardProcessor:
             if enable_cache:
                 await self.cache.store_result(image_bytes, parsed_data)
 
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
 
             return ProcessingResult(
                 success=True,
@@ -729,7 +775,7 @@ class HighPerformanceCardProcessor:
             return ProcessingResult(
                 success=False,
                 error=str(e),
-                processing_time=time.time() - start_time,
+                processing_time=time.perf_counter() - start_time,
                 optimizations_applied=["multi_card"],
             )
 
@@ -765,17 +811,20 @@ class HighPerformanceCardProcessor:
         - 並行圖片預處理
         - 智能批次快取
         """
-        start_time = time.time()
+        start_time = time.perf_counter()
         optimizations = ["true_batch_processing", "batch_multi_card"]
         batch_size = batch_size or len(image_data_list)
 
         try:
-            self.logger.info(f"🚀 開始批次多名片 AI 處理 ({batch_size} 張圖片)")
+            self.logger.info("🚀 開始批次多名片 AI 處理 (%d 張圖片)", batch_size)
 
             # === 階段 1: 檢查批次快取 ===
             if enable_cache and batch_size <= 5:  # 只對小批次啟用快取
-                # 創建批次快取鍵
-                batch_cache_key = self._create_batch_cache_key(image_data_list)
+                # 創建批次快取鍵（整批雜湊在線程池中計算，不阻塞事件循環）
+                loop = asyncio.get_running_loop()
+                batch_cache_key = await loop.run_in_executor(
+                    self.thread_pool, self._create_batch_cache_key, image_data_list
+                )
                 cached_result = await self.cache.get_cached_result_async(
                     batch_cache_key
                 )
@@ -785,7 +834,7 @@ class HighPerformanceCardProcessor:
                     return ProcessingResult(
                         success=True,
                         data=cached_result,
-                        processing_time=time.time() - start_time,
+                        processing_time=time.perf_counter() - start_time,
                         cache_hit=True,
                         optimizations_applied=optimizations + ["batch_cache_hit"],
                     )
@@ -804,7 +853,7 @@ class HighPerformanceCardProcessor:
             optimizations.append("optimized_batch_prompt")
 
             # === 階段 4: 單次批次 AI 調用 ===
-            ai_start = time.time()
+            ai_start = time.perf_counter()
 
             # 準備批次請求
             batch_parts = []
@@ -827,13 +876,15 @@ class HighPerformanceCardProcessor:
             # 添加批次處理指令
             batch_parts.append({"role": "user", "content": batch_prompt})
 
-            # 發送批次請求
-            async with aiohttp.ClientSession() as session:
-                response = await self._send_batch_ai_request(session, batch_parts)
+            # 發送批次請求（重用共享連接池，避免每批重建 session 與握手）
+            session = await self._get_http_session()
+            response = await self._send_batch_ai_request(session, batch_parts)
 
-            ai_time = time.time() - ai_start
+            # 延遲格式化：日誌級別關閉時不產生字串
             self.logger.info(
-                f"⚡ 批次 AI 處理完成: {ai_time:.2f}s ({batch_size} 張圖片)"
+                "⚡ 批次 AI 處理完成: %.2fs (%d 張圖片)",
+                time.perf_counter() - ai_start,
+                batch_size,
             )
 
             # === 階段 5: 解析批次結果 ===
@@ -848,7 +899,7 @@ class HighPerformanceCardProcessor:
                 await self.cache.store_result(batch_cache_key, parsed_data)
                 optimizations.append("batch_cache_stored")
 
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
 
             # 更新統計
             self.processing_stats["total_processed"] += batch_size
@@ -857,8 +908,9 @@ class HighPerformanceCardProcessor:
             )
 
             self.logger.info(
-                f"✅ 批次處理完成: {processing_time:.2f}s "
-                f"(平均 {processing_time/batch_size:.2f}s/張)"
+                "✅ 批次處理完成: %.2fs (平均 %.2fs/張)",
+                processing_time,
+                processing_time / batch_size,
             )
 
             return ProcessingResult(
@@ -878,7 +930,7 @@ class HighPerformanceCardProcessor:
             )
 
         except Exception as e:
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
             self.logger.error(f"❌ 批次處理失敗: {e}")
 
             return ProcessingResult(
@@ -890,8 +942,6 @@ class HighPerformanceCardProcessor:
 
     def _create_batch_cache_key(self, image_data_list: List[bytes]) -> str:
         """創建批次快取鍵"""
-        import hashlib
-
         # 創建所有圖片的組合雜湊
         combined_hash = hashlib.sha256()
         for image_data in image_data_list:
@@ -942,9 +992,7 @@ class HighPerformanceCardProcessor:
     ) -> str:
         """發送批次 AI 請求"""
         # 這裡需要根據實際的 AI 服務 API 來實現
-        # 暫時返回模擬響應
-        await asyncio.sleep(0.5)  # 模擬 AI 處理時間
-
+        # 暫時返回模擬響應（不再人為 sleep，避免每批固定增加延遲）
         # 模擬批次響應
         mock_response = {
             "cards": [
@@ -1002,14 +1050,17 @@ class HighPerformanceCardProcessor:
             if hasattr(self, "thread_pool"):
                 self.thread_pool.shutdown(wait=True)
 
+            if self.cpu_pool is not None:
+                self.cpu_pool.shutdown(wait=True)
+
             self.logger.info("✅ HighPerformanceCardProcessor 資源已清理")
 
         except Exception as e:
             self.logger.warning(f"清理資源時發生錯誤: {e}")
 
 
-# 便利工廠函數
-async def create_high_performance_processor() -> HighPerformanceCardProcessor:
+# 便利工廠函數（初始化不含 await，直接同步建立，免去協程物件開銷）
+def create_high_performance_processor() -> HighPerformanceCardProcessor:
     """創建高效能處理器"""
     processor = HighPerformanceCardProcessor()
     return processor
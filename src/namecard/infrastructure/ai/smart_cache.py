@@ -4,21 +4,64 @@
 """
 
 import asyncio
+import copy
 import hashlib
 import io
 import json
 import os
 import pickle
+import sqlite3
+import threading
 import time
 from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
 
 import aiofiles
 import redis.asyncio as redis
 from PIL import Image
 
+try:
+    import zstandard as zstd
+except ImportError:  # 未安裝 zstandard 時磁碟快取不壓縮
+    zstd = None
+
+# 超過此大小的序列化/反序列化移到執行緒執行，避免阻塞事件循環
+PICKLE_OFFLOAD_THRESHOLD = 64 * 1024
+
+# 磁碟快取 zstd 壓縮等級
+ZSTD_LEVEL = 3
+
+# 磁碟快取索引（SQLite）與舊版 JSON 索引檔名
+DISK_INDEX_DB = "index.db"
+LEGACY_INDEX_FILE = "cache_index.json"
+
+# Redis 客戶端快取：追蹤的鍵值前綴、失效通知頻道與本地副本上限
+# （本地副本不計入記憶體快取預算，另以位元組上限約束；存活時間限制漏收通知時的過時範圍）
+REDIS_TRACKING_PREFIX = "card_processing:"
+REDIS_INVALIDATE_CHANNEL = "__redis__:invalidate"
+REDIS_NEAR_CACHE_MAX_ENTRIES = 256
+REDIS_NEAR_CACHE_MAX_BYTES = 16 * 1024 * 1024
+REDIS_NEAR_CACHE_TTL = 60.0
+
+# 快取統計結果的有效時間（秒）
+STATS_CACHE_TTL = 1.0
+
+
+def _pickle_size_hint(value: Any) -> int:
+    """粗估序列化大小（只計算字串/位元組與第一層容器內的字串/位元組）"""
+    sized = (str, bytes, bytearray, memoryview)
+    if isinstance(value, sized):
+        return len(value)
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, (list, tuple)):
+        items = value
+    else:
+        return 0
+    return sum(len(item) for item in items if isinstance(item, sized))
+
 
 @dataclass
 class CacheEntry:
@@ -26,20 +69,209 @@ class CacheEntry:
 
     key: str
     value: Any
-    created_at: datetime
-    last_accessed: datetime
+    created_at: float  # time.monotonic() 時間戳
+    last_accessed: float  # time.monotonic() 時間戳
     access_count: int
     size_bytes: int
     ttl_seconds: int
 
     def is_expired(self) -> bool:
         """檢查是否過期"""
-        return datetime.now() > self.created_at + timedelta(seconds=self.ttl_seconds)
+        return time.monotonic() > self.created_at + self.ttl_seconds
 
     def should_evict(self, max_idle_time: int = 3600) -> bool:
         """檢查是否應該被驅逐"""
-        idle_time = (datetime.now() - self.last_accessed).total_seconds()
-        return idle_time > max_idle_time
+        return time.monotonic() - self.last_accessed > max_idle_time
+
+
+class S3FIFOCache:
+    """
+    S3-FIFO 記憶體快取 - 依位元組計算容量
+
+    新項目先進入 small 佇列，被再次存取過才晉升到 main 佇列；
+    未被存取就被驅逐的鍵值記錄在 ghost 佇列，再次寫入時直接進入 main。
+    一次性掃描的資料只會在 small 佇列中流過，不會擠掉熱門項目。
+    存取頻率取自 CacheEntry.access_count（寫入時為 1）。
+    """
+
+    MAX_FREQUENCY = 3
+
+    def __init__(self, max_size: int, small_ratio: float = 0.1):
+        self.max_size = max_size
+        self.small_max_size = int(max_size * small_ratio)
+        self.small: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.main: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.ghost: OrderedDict[str, None] = OrderedDict()
+        self.small_size = 0
+        self.main_size = 0
+
+    @property
+    def size(self) -> int:
+        """目前佔用的位元組數"""
+        return self.small_size + self.main_size
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.small or key in self.main
+
+    def __getitem__(self, key: str) -> CacheEntry:
+        if key in self.small:
+            return self.small[key]
+        return self.main[key]
+
+    def __delitem__(self, key: str):
+        self.pop(key)
+
+    def __len__(self) -> int:
+        return len(self.small) + len(self.main)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.small
+        yield from self.main
+
+    def values(self) -> List[CacheEntry]:
+        return [*self.small.values(), *self.main.values()]
+
+    def items(self) -> List[Tuple[str, CacheEntry]]:
+        return [*self.small.items(), *self.main.items()]
+
+    def pop(self, key: str, default: Any = None) -> Optional[CacheEntry]:
+        """移除項目（不記入 ghost）"""
+        if key in self.small:
+            entry = self.small.pop(key)
+            self.small_size -= entry.size_bytes
+            return entry
+        if key in self.main:
+            entry = self.main.pop(key)
+            self.main_size -= entry.size_bytes
+            return entry
+        return default
+
+    def clear(self):
+        self.small.clear()
+        self.main.clear()
+        self.ghost.clear()
+        self.small_size = 0
+        self.main_size = 0
+
+    def admits(self, size: int) -> bool:
+        """大小超過整體容量的項目不予收錄"""
+        return size <= self.max_size
+
+    def put(self, entry: CacheEntry):
+        """寫入項目（呼叫前需先以 make_room 騰出空間）"""
+        self.pop(entry.key)
+        if entry.key in self.ghost:
+            del self.ghost[entry.key]
+            self.main[entry.key] = entry
+            self.main_size += entry.size_bytes
+        else:
+            self.small[entry.key] = entry
+            self.small_size += entry.size_bytes
+
+    def make_room(self, needed_size: int) -> int:
+        """驅逐項目直到可容納 needed_size，回傳驅逐數量"""
+        evicted = 0
+        while self.size + needed_size > self.max_size and len(self):
+            if self.small and (self.small_size >= self.small_max_size or not self.main):
+                evicted += self._evict_small()
+            else:
+                evicted += self._evict_main()
+        return evicted
+
+    def _evict_small(self) -> int:
+        key, entry = self.small.popitem(last=False)
+        self.small_size -= entry.size_bytes
+        if entry.access_count > 1:
+            # 在 small 佇列期間被存取過，晉升到 main
+            entry.access_count = 1
+            self.main[key] = entry
+            self.main_size += entry.size_bytes
+            return 0
+
+        self.ghost[key] = None
+        while len(self.ghost) > max(len(self), 64):
+            self.ghost.popitem(last=False)
+        return 1
+
+    def _evict_main(self) -> int:
+        key, entry = self.main.popitem(last=False)
+        self.main_size -= entry.size_bytes
+        if entry.access_count > 1:
+            # 仍有存取頻率，降低頻率後重新放回佇列尾端
+            entry.access_count = min(entry.access_count, self.MAX_FREQUENCY + 1) - 1
+            self.main[key] = entry
+            self.main_size += entry.size_bytes
+            return 0
+        return 1
+
+
+class ShardedMemoryCache:
+    """
+    分片記憶體快取 - 依鍵值雜湊分配到多個 S3-FIFO 分片
+
+    每個分片有獨立的容量預算與鎖，驅逐只在單一分片內進行。
+    分片數依容量調整，確保每個分片至少有 MIN_SHARD_SIZE 可用。
+    """
+
+    MAX_SHARDS = 16
+    MIN_SHARD_SIZE = 1024 * 1024
+
+    def __init__(self, max_size: int):
+        shard_count = self.MAX_SHARDS
+        while shard_count > 1 and max_size // shard_count < self.MIN_SHARD_SIZE:
+            shard_count //= 2
+
+        self._shard_mask = shard_count - 1
+        self.shards = [S3FIFOCache(max_size // shard_count) for _ in range(shard_count)]
+        # 鎖延遲到事件循環中建立（Python 3.9 的 Lock 建立時即綁定事件循環）
+        self.shard_locks: List[Optional[asyncio.Lock]] = [None] * shard_count
+
+    def shard_index(self, key: str) -> int:
+        return hash(key) & self._shard_mask
+
+    def shard_for(self, key: str) -> S3FIFOCache:
+        return self.shards[self.shard_index(key)]
+
+    def lock_for(self, key: str) -> asyncio.Lock:
+        index = self.shard_index(key)
+        lock = self.shard_locks[index]
+        if lock is None:
+            lock = self.shard_locks[index] = asyncio.Lock()
+        return lock
+
+    @property
+    def size(self) -> int:
+        """目前佔用的位元組數"""
+        return sum(shard.size for shard in self.shards)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.shard_for(key)
+
+    def __getitem__(self, key: str) -> CacheEntry:
+        return self.shard_for(key)[key]
+
+    def __delitem__(self, key: str):
+        del self.shard_for(key)[key]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self) -> Iterator[str]:
+        for shard in self.shards:
+            yield from shard
+
+    def values(self) -> List[CacheEntry]:
+        return [entry for shard in self.shards for entry in shard.values()]
+
+    def items(self) -> List[Tuple[str, CacheEntry]]:
+        return [item for shard in self.shards for item in shard.items()]
+
+    def pop(self, key: str, default: Any = None) -> Optional[CacheEntry]:
+        return self.shard_for(key).pop(key, default)
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
 
 
 class SmartCacheManager:
@@ -66,9 +298,34 @@ class SmartCacheManager:
         self.cache_dir = cache_dir
 
         # 三層快取架構
-        self.memory_cache: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.memory_cache = ShardedMemoryCache(self.max_memory_size)
         self.redis_client: Optional[redis.Redis] = None
         self.disk_cache_index: Dict[str, Dict[str, Any]] = {}
+        self._disk_cache_bytes = 0  # 索引中檔案大小總和，隨索引增減更新
+
+        # 進行中的計算（同一鍵值的並發未命中共用一次計算）
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # 每個計算任務目前的等待者數，歸零時取消任務
+        self._inflight_waiters: Dict[asyncio.Task, int] = {}
+
+        # Redis 客戶端快取（僅在失效通知監聽中時使用）
+        # 鍵值 -> (值, 序列化大小, 到期時間 time.monotonic())
+        self._redis_near_cache: OrderedDict[str, Tuple[Any, int, float]] = OrderedDict()
+        self._redis_near_cache_bytes = 0
+        self._redis_tracking_active = False
+        self._redis_tracking_task: Optional[asyncio.Task] = None
+        self._redis_tracking_client: Optional[redis.Redis] = None
+        self._redis_pubsub: Optional[redis.client.PubSub] = None
+        self._redis_invalidation_epoch = 0
+
+        # 磁碟索引延遲寫入（合併短時間內的多次變更，只寫入有變動的鍵值）
+        self._index_dirty: Optional[asyncio.Event] = None  # 隨背景任務建立
+        self._index_dirty_keys: set = set()
+        self._index_flush_task: Optional[asyncio.Task] = None
+        self._index_flush_delay = 0.25
+        # 索引資料庫連接只開啟一次，於執行緒中使用時以鎖保護
+        self._index_db: Optional[sqlite3.Connection] = None
+        self._index_db_lock = threading.Lock()
 
         # 統計資訊
         self.stats = {
@@ -79,6 +336,7 @@ class SmartCacheManager:
             "evictions": 0,
             "total_requests": 0,
         }
+        self._stats_cache: Tuple[float, Optional[Dict[str, Any]]] = (0.0, None)
 
         # 初始化快取層
         self._init_cache_layers()
@@ -101,6 +359,9 @@ class SmartCacheManager:
         if redis_url:
             try:
                 self.redis_client = redis.from_url(redis_url)
+                self._redis_tracking_task = asyncio.create_task(
+                    self._start_redis_tracking()
+                )
                 print("✅ Redis 快取層已啟用")
             except Exception as e:
                 print(f"⚠️ Redis 連接失敗: {e}")
@@ -121,10 +382,8 @@ class SmartCacheManager:
         if key in self.memory_cache:
             entry = self.memory_cache[key]
             if not entry.is_expired():
-                entry.last_accessed = datetime.now()
+                entry.last_accessed = time.monotonic()
                 entry.access_count += 1
-                # 移到最前面（LRU）
-                self.memory_cache.move_to_end(key, last=False)
                 self.stats["memory_hits"] += 1
                 return entry.value
             else:
@@ -133,12 +392,23 @@ class SmartCacheManager:
 
         # 層級 2：Redis 快取（中等速度）
         if self.redis_client:
+            # 客戶端快取副本由伺服器失效通知維護一致性，命中時免網路往返
+            near_entry = self._redis_near_cache.get(key)
+            if near_entry is not None:
+                if time.monotonic() < near_entry[2]:
+                    self._redis_near_cache.move_to_end(key)
+                    self.stats["redis_hits"] += 1
+                    return near_entry[0]
+                self._pop_redis_near_cache(key)
+
             try:
+                epoch = self._redis_invalidation_epoch
                 cached_data = await self.redis_client.get(key)
                 if cached_data:
-                    value = pickle.loads(cached_data)
+                    value = await self._loads(cached_data)
+                    self._remember_redis_value(key, value, len(cached_data), epoch)
                     # 提升到記憶體快取
-                    await self._promote_to_memory(key, value, ttl_seconds=3600)
+                    await self._promote_to_memory(key, value, 3600, len(cached_data))
                     self.stats["redis_hits"] += 1
                     return value
             except Exception as e:
@@ -149,32 +419,104 @@ class SmartCacheManager:
             file_info = self.disk_cache_index[key]
             file_path = os.path.join(self.cache_dir, file_info["filename"])
 
-            if os.path.exists(file_path):
-                try:
-                    # 檢查是否過期
-                    created_at = datetime.fromisoformat(file_info["created_at"])
-                    if datetime.now() < created_at + timedelta(
-                        seconds=file_info["ttl"]
-                    ):
-                        async with aiofiles.open(file_path, "rb") as f:
-                            content = await f.read()
-                            value = pickle.loads(content)
-
-                        # 提升到上層快取
-                        await self._promote_to_redis(key, value, file_info["ttl"])
-                        await self._promote_to_memory(key, value, file_info["ttl"])
-
-                        self.stats["disk_hits"] += 1
-                        return value
-                    else:
-                        # 過期，清理
-                        await self._remove_from_disk(key)
-                except Exception as e:
-                    print(f"⚠️ 磁碟快取讀取錯誤: {e}")
+            try:
+                # 檢查是否過期
+                created_at = datetime.fromisoformat(file_info["created_at"])
+                if datetime.now() < created_at + timedelta(seconds=file_info["ttl"]):
+                    # 依索引大小預先配置緩衝區，直接讀入避免額外複製
+                    buffer = bytearray(file_info["size"])
+                    async with aiofiles.open(file_path, "rb") as f:
+                        read_size = await f.readinto(buffer)
+                    data = memoryview(buffer)[:read_size]
+                    if file_info.get("compressed"):
+                        data = await self._decompress(data)
+                    value = await self._loads(data)
+
+                    # 提升到上層快取
+                    await self._promote_to_redis(key, data, file_info["ttl"])
+                    await self._promote_to_memory(
+                        key, value, file_info["ttl"], len(data)
+                    )
+
+                    self.stats["disk_hits"] += 1
+                    return value
+                else:
+                    # 過期，清理
+                    await self._remove_from_disk(key)
+            except FileNotFoundError:
+                # 檔案已被外部刪除，同步索引
+                await self._remove_from_disk(key)
+            except Exception as e:
+                print(f"⚠️ 磁碟快取讀取錯誤: {e}")
 
         self.stats["misses"] += 1
         return None
 
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl_seconds: int = 3600,
+        cache_level: str = "auto",
+    ) -> Any:
+        """
+        獲取快取值，未命中時計算並寫入 - 並發未命中只會計算一次
+
+        Args:
+            key: 快取鍵值
+            compute: 未命中時呼叫的協程函數
+            ttl_seconds: 生存時間（秒）
+            cache_level: 快取層級 (auto/memory/redis/disk)
+
+        Returns:
+            快取值或計算結果（None 不會被快取）
+        """
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            value = await self.get(key)
+            if value is not None:
+                return value
+            # 查詢期間可能已有其他協程開始計算
+            inflight = self._inflight.get(key)
+
+        if inflight is None or inflight.done():
+            # 計算在獨立任務中執行，發起者被取消不會波及其他等待者
+            inflight = asyncio.create_task(
+                self._compute_and_set(key, compute, ttl_seconds, cache_level)
+            )
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda done: self._finish_inflight(key, done))
+
+        # 最後一個等待者離開時才取消計算
+        self._inflight_waiters[inflight] = self._inflight_waiters.get(inflight, 0) + 1
+        try:
+            return await asyncio.shield(inflight)
+        finally:
+            self._inflight_waiters[inflight] -= 1
+            if not self._inflight_waiters[inflight]:
+                del self._inflight_waiters[inflight]
+                if not inflight.done():
+                    inflight.cancel()
+                    self._finish_inflight(key, inflight)
+
+    async def _compute_and_set(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl_seconds: int,
+        cache_level: str,
+    ) -> Any:
+        """執行計算並寫入快取（None 不會被快取）"""
+        value = await compute()
+        if value is not None:
+            await self.set(key, value, ttl_seconds, cache_level)
+        return value
+
+    def _finish_inflight(self, key: str, task: asyncio.Task):
+        """移出進行中的計算紀錄（只移除同一個任務）"""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
     async def set(
         self, key: str, value: Any, ttl_seconds: int = 3600, cache_level: str = "auto"
     ):
@@ -187,118 +529,266 @@ class SmartCacheManager:
             ttl_seconds: 生存時間（秒）
             cache_level: 快取層級 (auto/memory/redis/disk)
         """
-        # 計算值的大小
-        value_size = len(pickle.dumps(value))
+        # 只序列化一次，同時取得大小供層級判斷與寫入使用
+        # （明確指定大型層級或預估為大型值時，序列化移出事件循環）
+        offload = (
+            cache_level in ("redis", "disk")
+            or _pickle_size_hint(value) > PICKLE_OFFLOAD_THRESHOLD
+        )
+        serialized = await self._dumps(value, offload=offload)
+        value_size = len(serialized)
 
         if cache_level == "auto":
-            # 自動決定最適合的快取層級
-            if value_size < 1024 * 50:  # < 50KB，存到記憶體
-                cache_level = "memory"
-            elif value_size < 1024 * 500:  # < 500KB，存到 Redis
-                cache_level = "redis"
+            # 自動決定所有要寫入的快取層級
+            if value_size < 1024 * 50:  # < 50KB，存到記憶體並寫穿到 Redis
+                targets = {"memory", "redis"}
+            elif value_size < 1024 * 500:  # < 500KB，存到 Redis（未啟用時存磁碟）
+                targets = {"redis"} if self.redis_client else {"disk"}
             else:  # >= 500KB，存到磁碟
-                cache_level = "disk"
+                targets = {"disk"}
+        else:
+            targets = {cache_level}
 
-        # 根據策略存儲
-        if cache_level == "memory" or cache_level == "auto":
+        # 根據策略存儲，Redis 與磁碟寫入同時進行
+        if "memory" in targets:
             await self._set_memory(key, value, ttl_seconds, value_size)
 
-        if cache_level == "redis" and self.redis_client:
-            await self._set_redis(key, value, ttl_seconds)
-
-        if cache_level == "disk":
-            await self._set_disk(key, value, ttl_seconds, value_size)
+        writes = []
+        if "redis" in targets and self.redis_client:
+            writes.append(self._set_redis(key, serialized, ttl_seconds))
+        if "disk" in targets:
+            writes.append(self._set_disk(key, serialized, ttl_seconds))
+        if writes:
+            await asyncio.gather(*writes)
 
     async def _set_memory(self, key: str, value: Any, ttl: int, size: int):
         """設定記憶體快取"""
-        # 檢查記憶體容量
-        await self._ensure_memory_capacity(size)
-
-        entry = CacheEntry(
-            key=key,
-            value=value,
-            created_at=datetime.now(),
-            last_accessed=datetime.now(),
-            access_count=1,
-            size_bytes=size,
-            ttl_seconds=ttl,
-        )
+        shard = self.memory_cache.shard_for(key)
+        async with self.memory_cache.lock_for(key):
+            shard.pop(key)
+            if not shard.admits(size):
+                return
+
+            # 檢查分片容量
+            await self._ensure_memory_capacity(shard, size)
+
+            now = time.monotonic()
+            entry = CacheEntry(
+                key=key,
+                value=value,
+                created_at=now,
+                last_accessed=now,
+                access_count=1,
+                size_bytes=size,
+                ttl_seconds=ttl,
+            )
 
-        self.memory_cache[key] = entry
-        # 新項目放到最前面
-        self.memory_cache.move_to_end(key, last=False)
+            shard.put(entry)
 
-    async def _set_redis(self, key: str, value: Any, ttl: int):
-        """設定 Redis 快取"""
+    async def _set_redis(
+        self, key: str, serialized: bytes, ttl: int, only_if_missing: bool = False
+    ):
+        """設定 Redis 快取（only_if_missing 時使用 SET NX，不覆蓋較新的值）"""
         if not self.redis_client:
             return
 
         try:
-            serialized = pickle.dumps(value)
-            await self.redis_client.setex(key, ttl, serialized)
+            await self.redis_client.set(key, serialized, ex=ttl, nx=only_if_missing)
+            self._pop_redis_near_cache(key)
         except Exception as e:
             print(f"⚠️ Redis 寫入錯誤: {e}")
 
-    async def _set_disk(self, key: str, value: Any, ttl: int, size: int):
-        """設定磁碟快取"""
-        # 檢查磁碟容量
-        await self._ensure_disk_capacity(size)
+    async def _start_redis_tracking(self):
+        """啟用 Redis 客戶端快取 - 監聽連接重連後重新啟用追蹤"""
+        try:
+            while await self._listen_redis_invalidations():
+                print("⚠️ Redis 失效通知連接已重連，重新啟用客戶端快取")
+        except Exception as e:
+            print(f"⚠️ Redis 客戶端快取停用: {e}")
+        finally:
+            # 收不到失效通知時本地副本不再可信
+            self._redis_tracking_active = False
+            self._clear_redis_near_cache()
+            await self._close_redis_tracking()
+
+    async def _listen_redis_invalidations(self) -> bool:
+        """以 BCAST 模式追蹤前綴並監聽失效通知，監聽連接重連時返回 True"""
+        await self._close_redis_tracking()
+
+        self._redis_pubsub = self.redis_client.pubsub()
+        await self._redis_pubsub.connect()
+        await self._redis_pubsub.connection.send_command("CLIENT", "ID")
+        listener_id = await self._redis_pubsub.connection.read_response()
+        await self._redis_pubsub.subscribe(REDIS_INVALIDATE_CHANNEL)
+
+        # 追蹤設定綁定在連接上，需保留專用連接
+        self._redis_tracking_client = self.redis_client.client()
+        await self._redis_tracking_client.client_tracking_on(
+            clientid=listener_id, bcast=True, prefix=[REDIS_TRACKING_PREFIX]
+        )
+        self._redis_tracking_active = True
+
+        subscribed = False
+        async for message in self._redis_pubsub.listen():
+            if message["type"] == "subscribe":
+                if subscribed:
+                    # 重連後自動重新訂閱：CLIENT ID 已改變，REDIRECT 不再送達，
+                    # 斷線期間的失效通知也已遺失
+                    self._redis_tracking_active = False
+                    self._invalidate_redis_near_cache(None)
+                    return True
+                subscribed = True
+            elif message["type"] == "message":
+                self._invalidate_redis_near_cache(message["data"])
+        return False
+
+    async def _close_redis_tracking(self):
+        """關閉失效通知監聽連接與追蹤專用連接"""
+        pubsub, self._redis_pubsub = self._redis_pubsub, None
+        tracking_client, self._redis_tracking_client = (
+            self._redis_tracking_client,
+            None,
+        )
+        for connection in (pubsub, tracking_client):
+            if connection is None:
+                continue
+            try:
+                await connection.aclose()
+            except Exception as e:
+                print(f"⚠️ 關閉 Redis 追蹤連接錯誤: {e}")
+
+    def _invalidate_redis_near_cache(self, keys: Optional[List[Any]]):
+        """處理 Redis 失效通知（None 代表整個資料庫被清空）"""
+        self._redis_invalidation_epoch += 1
+        if keys is None:
+            self._clear_redis_near_cache()
+            return
+
+        for key in keys:
+            if isinstance(key, bytes):
+                key = key.decode()
+            self._pop_redis_near_cache(key)
 
+    def _remember_redis_value(self, key: str, value: Any, size: int, epoch: int):
+        """保存 Redis 讀取結果的本地副本（size 為序列化大小）"""
+        if not self._redis_tracking_active or not key.startswith(REDIS_TRACKING_PREFIX):
+            return
+        # 讀取期間收到失效通知，結果可能已過時
+        if epoch != self._redis_invalidation_epoch:
+            return
+        if size > REDIS_NEAR_CACHE_MAX_BYTES:
+            return
+
+        self._pop_redis_near_cache(key)
+        self._redis_near_cache[key] = (
+            value,
+            size,
+            time.monotonic() + REDIS_NEAR_CACHE_TTL,
+        )
+        self._redis_near_cache_bytes += size
+        while (
+            len(self._redis_near_cache) > REDIS_NEAR_CACHE_MAX_ENTRIES
+            or self._redis_near_cache_bytes > REDIS_NEAR_CACHE_MAX_BYTES
+        ):
+            _, (_, evicted_size, _) = self._redis_near_cache.popitem(last=False)
+            self._redis_near_cache_bytes -= evicted_size
+
+    def _pop_redis_near_cache(self, key: str):
+        """移除單一本地副本"""
+        entry = self._redis_near_cache.pop(key, None)
+        if entry is not None:
+            self._redis_near_cache_bytes -= entry[1]
+
+    def _clear_redis_near_cache(self):
+        """清空本地副本"""
+        self._redis_near_cache.clear()
+        self._redis_near_cache_bytes = 0
+
+    async def _set_disk(self, key: str, serialized: bytes, ttl: int):
+        """設定磁碟快取"""
         filename = f"{hashlib.md5(key.encode()).hexdigest()}.cache"
         file_path = os.path.join(self.cache_dir, filename)
 
         try:
-            serialized = pickle.dumps(value)
+            compressed = zstd is not None
+            if compressed:
+                serialized = await asyncio.to_thread(
+                    zstd.compress, serialized, ZSTD_LEVEL
+                )
+
+            # 依實際寫入磁碟的（壓縮後）大小檢查容量
+            await self._ensure_disk_capacity(len(serialized))
+
             async with aiofiles.open(file_path, "wb") as f:
                 await f.write(serialized)
 
-            # 更新索引
+            # 更新索引（size 記錄實際寫入磁碟的位元組數）
+            # 先移除舊項目，讓索引順序維持建立時間順序
+            old_info = self.disk_cache_index.pop(key, None)
+            if old_info is not None:
+                self._disk_cache_bytes -= old_info["size"]
             self.disk_cache_index[key] = {
                 "filename": filename,
-                "size": size,
+                "size": len(serialized),
                 "created_at": datetime.now().isoformat(),
                 "ttl": ttl,
+                "compressed": compressed,
             }
+            self._disk_cache_bytes += len(serialized)
 
-            await self._save_disk_cache_index()
+            await self._save_disk_cache_index(key)
 
         except Exception as e:
             print(f"⚠️ 磁碟快取寫入錯誤: {e}")
 
-    async def _promote_to_memory(self, key: str, value: Any, ttl_seconds: int):
-        """提升到記憶體快取"""
-        value_size = len(pickle.dumps(value))
+    async def _dumps(self, value: Any, offload: bool = False) -> bytes:
+        """序列化快取值，大型值交由執行緒處理"""
+        if offload:
+            return await asyncio.to_thread(pickle.dumps, value)
+        return pickle.dumps(value)
+
+    async def _loads(self, data) -> Any:
+        """反序列化快取值，超過門檻時交由執行緒處理"""
+        if len(data) > PICKLE_OFFLOAD_THRESHOLD:
+            return await asyncio.to_thread(pickle.loads, data)
+        return pickle.loads(data)
+
+    async def _decompress(self, data) -> bytes:
+        """解壓縮磁碟快取內容，超過門檻時交由執行緒處理"""
+        if zstd is None:
+            raise RuntimeError("磁碟快取已壓縮，但未安裝 zstandard")
+        if len(data) > PICKLE_OFFLOAD_THRESHOLD:
+            return await asyncio.to_thread(zstd.decompress, data)
+        return zstd.decompress(data)
+
+    async def _promote_to_memory(
+        self, key: str, value: Any, ttl_seconds: int, value_size: int
+    ):
+        """提升到記憶體快取（value_size 為呼叫端已知的序列化大小）"""
         if value_size < 1024 * 100:  # 只有小於 100KB 的才提升到記憶體
             await self._set_memory(key, value, ttl_seconds, value_size)
 
-    async def _promote_to_redis(self, key: str, value: Any, ttl_seconds: int):
+    async def _promote_to_redis(self, key: str, serialized: bytes, ttl_seconds: int):
         """提升到 Redis 快取"""
         if self.redis_client:
-            await self._set_redis(key, value, ttl_seconds)
-
-    async def _ensure_memory_capacity(self, needed_size: int):
-        """確保記憶體容量足夠"""
-        current_size = sum(entry.size_bytes for entry in self.memory_cache.values())
+            await self._set_redis(key, serialized, ttl_seconds, only_if_missing=True)
 
-        while current_size + needed_size > self.max_memory_size and self.memory_cache:
-            # LRU 驅逐：移除最久未使用的項目
-            oldest_key = next(reversed(self.memory_cache))
-            evicted_entry = self.memory_cache.pop(oldest_key)
-            current_size -= evicted_entry.size_bytes
-            self.stats["evictions"] += 1
+    async def _ensure_memory_capacity(self, shard: S3FIFOCache, needed_size: int):
+        """確保記憶體分片容量足夠"""
+        self.stats["evictions"] += shard.make_room(needed_size)
 
     async def _ensure_disk_capacity(self, needed_size: int):
         """確保磁碟容量足夠"""
-        current_size = sum(info["size"] for info in self.disk_cache_index.values())
-
-        while current_size + needed_size > self.max_disk_size and self.disk_cache_index:
-            # 找到最舊的檔案並移除
-            oldest_key = min(
-                self.disk_cache_index.keys(),
-                key=lambda k: self.disk_cache_index[k]["created_at"],
-            )
+        while (
+            self._disk_cache_bytes + needed_size > self.max_disk_size
+            and self.disk_cache_index
+        ):
+            # 索引依建立時間排序，第一個即為最舊的檔案
+            oldest_key = next(iter(self.disk_cache_index))
             await self._remove_from_disk(oldest_key)
-            current_size = sum(info["size"] for info in self.disk_cache_index.values())
+            if oldest_key in self.disk_cache_index:
+                # 移除失敗，避免無限迴圈
+                break
 
     async def _remove_from_disk(self, key: str):
         """從磁碟移除快取項目"""
@@ -309,37 +799,148 @@ class SmartCacheManager:
         file_path = os.path.join(self.cache_dir, file_info["filename"])
 
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            del self.disk_cache_index[key]
-            await self._save_disk_cache_index()
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
         except Exception as e:
             print(f"⚠️ 移除磁碟快取錯誤: {e}")
+            return
+
+        del self.disk_cache_index[key]
+        self._disk_cache_bytes -= file_info["size"]
+        await self._save_disk_cache_index(key)
 
     async def _load_disk_cache_index(self):
-        """載入磁碟快取索引"""
-        index_file = os.path.join(self.cache_dir, "cache_index.json")
+        """載入磁碟快取索引（首次啟動時匯入舊版 JSON 索引）"""
         try:
-            if os.path.exists(index_file):
-                async with aiofiles.open(index_file, "r", encoding="utf-8") as f:
-                    content = await f.read()
-                    self.disk_cache_index = json.loads(content)
-                print(f"✅ 載入磁碟快取索引: {len(self.disk_cache_index)} 項目")
+            index = await asyncio.to_thread(self._read_index_db)
+
+            legacy_file = os.path.join(self.cache_dir, LEGACY_INDEX_FILE)
+            if not index and os.path.exists(legacy_file):
+                async with aiofiles.open(legacy_file, "r", encoding="utf-8") as f:
+                    legacy_index = json.loads(await f.read())
+                index = dict(
+                    sorted(legacy_index.items(), key=lambda item: item[1]["created_at"])
+                )
+                rows = [self._index_row(key, info) for key, info in index.items()]
+                await asyncio.to_thread(self._write_index_db, rows, [])
+                os.remove(legacy_file)
+
+            # 載入期間新增的項目較新，排在後面
+            index.update(self.disk_cache_index)
+            self.disk_cache_index = index
+            self._disk_cache_bytes = sum(info["size"] for info in index.values())
+            print(f"✅ 載入磁碟快取索引: {len(self.disk_cache_index)} 項目")
         except Exception as e:
             print(f"⚠️ 載入磁碟快取索引失敗: {e}")
-            self.disk_cache_index = {}
 
-    async def _save_disk_cache_index(self):
-        """儲存磁碟快取索引"""
-        index_file = os.path.join(self.cache_dir, "cache_index.json")
+    async def _save_disk_cache_index(self, key: str):
+        """標記索引項目需要儲存，由背景任務合併寫入"""
+        self._index_dirty_keys.add(key)
+        if self._index_flush_task is None or self._index_flush_task.done():
+            # 在目前事件循環中建立，避免 Python 3.9 跨事件循環綁定錯誤
+            self._index_dirty = asyncio.Event()
+            self._index_flush_task = asyncio.create_task(self._index_flush_loop())
+        self._index_dirty.set()
+
+    async def _index_flush_loop(self):
+        """背景寫入磁碟快取索引 - 每個變更高峰只寫入一次"""
+        while True:
+            await self._index_dirty.wait()
+            await asyncio.sleep(self._index_flush_delay)
+            self._index_dirty.clear()
+            await self._write_disk_cache_index()
+
+    async def _write_disk_cache_index(self):
+        """將有變動的索引項目寫入 SQLite（單一交易）"""
+        dirty_keys, self._index_dirty_keys = self._index_dirty_keys, set()
+        upserts = []
+        deletes = []
+        for key in dirty_keys:
+            info = self.disk_cache_index.get(key)
+            if info is None:
+                deletes.append((key,))
+            else:
+                upserts.append(self._index_row(key, info))
+
         try:
-            async with aiofiles.open(index_file, "w", encoding="utf-8") as f:
-                await f.write(
-                    json.dumps(self.disk_cache_index, indent=2, ensure_ascii=False)
-                )
+            await asyncio.to_thread(self._write_index_db, upserts, deletes)
+        except asyncio.CancelledError:
+            # 關閉時由最後一次寫入補上
+            self._index_dirty_keys |= dirty_keys
+            raise
         except Exception as e:
+            # 下次變更時重試
+            self._index_dirty_keys |= dirty_keys
             print(f"⚠️ 儲存磁碟快取索引失敗: {e}")
 
+    def _open_index_db(self) -> sqlite3.Connection:
+        """取得索引資料庫連接（首次使用時開啟並設定 WAL 模式，呼叫端需持有鎖）"""
+        if self._index_db is None:
+            conn = sqlite3.connect(
+                os.path.join(self.cache_dir, DISK_INDEX_DB), check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, filename TEXT, size INTEGER, "
+                "created_ts REAL, ttl INTEGER, compressed INTEGER)"
+            )
+            self._index_db = conn
+        return self._index_db
+
+    def _close_index_db(self):
+        """關閉索引資料庫連接"""
+        with self._index_db_lock:
+            if self._index_db is not None:
+                self._index_db.close()
+                self._index_db = None
+
+    def _read_index_db(self) -> Dict[str, Dict[str, Any]]:
+        """讀取索引資料庫，依建立時間排序"""
+        with self._index_db_lock:
+            rows = (
+                self._open_index_db()
+                .execute(
+                    "SELECT key, filename, size, created_ts, ttl, compressed "
+                    "FROM entries ORDER BY created_ts"
+                )
+                .fetchall()
+            )
+
+        return {
+            key: {
+                "filename": filename,
+                "size": size,
+                "created_at": datetime.fromtimestamp(created_ts).isoformat(),
+                "ttl": ttl,
+                "compressed": bool(compressed),
+            }
+            for key, filename, size, created_ts, ttl, compressed in rows
+        }
+
+    def _write_index_db(self, upserts: List[Tuple], deletes: List[Tuple[str]]):
+        """寫入索引變更"""
+        with self._index_db_lock:
+            conn = self._open_index_db()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", upserts
+                )
+                conn.executemany("DELETE FROM entries WHERE key = ?", deletes)
+
+    @staticmethod
+    def _index_row(key: str, info: Dict[str, Any]) -> Tuple:
+        """索引項目轉換為資料庫列"""
+        return (
+            key,
+            info["filename"],
+            info["size"],
+            datetime.fromisoformat(info["created_at"]).timestamp(),
+            info["ttl"],
+            int(info.get("compressed", False)),
+        )
+
     def generate_image_cache_key(
         self, image_bytes: bytes, processing_options: Dict[str, Any] = None
     ) -> str:
@@ -387,9 +988,13 @@ class SmartCacheManager:
         return True
 
     async def get_cache_stats(self) -> Dict[str, Any]:
-        """獲取快取統計"""
-        memory_size = sum(entry.size_bytes for entry in self.memory_cache.values())
-        disk_size = sum(info["size"] for info in self.disk_cache_index.values())
+        """獲取快取統計（結果快取 STATS_CACHE_TTL 秒，避免頻繁輪詢時重複統計）"""
+        cached_at, cached_stats = self._stats_cache
+        if cached_stats is not None and time.monotonic() - cached_at < STATS_CACHE_TTL:
+            return copy.deepcopy(cached_stats)
+
+        memory_size = self.memory_cache.size
+        disk_size = self._disk_cache_bytes
 
         # Redis 統計
         redis_stats = {}
@@ -414,7 +1019,7 @@ class SmartCacheManager:
             * 100
         )
 
-        return {
+        cache_stats = {
             "performance": {
                 "total_requests": total_requests,
                 "hit_rate_percentage": round(hit_rate, 2),
@@ -444,6 +1049,8 @@ class SmartCacheManager:
                 "redis": redis_stats,
             },
         }
+        self._stats_cache = (time.monotonic(), cache_stats)
+        return copy.deepcopy(cache_stats)
 
     async def cleanup_expired(self):
         """清理過期快取項目"""
@@ -477,6 +1084,7 @@ class SmartCacheManager:
         self.memory_cache.clear()
 
         # 清理 Redis
+        self._clear_redis_near_cache()
         if self.redis_client:
             try:
                 # 只清理我們的 keys（以 card_processing: 開頭）
@@ -492,5 +1100,24 @@ class SmartCacheManager:
 
         # 重置統計
         self.stats = {k: 0 for k in self.stats}
+        self._stats_cache = (0.0, None)
 
         print("🧹 已清理所有快取層")
+
+    async def close(self):
+        """關閉背景任務、Redis 追蹤連接與索引資料庫（尚未寫入的索引變更會先寫入）"""
+        for task in (self._redis_tracking_task, self._index_flush_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._redis_tracking_task = None
+        self._index_flush_task = None
+        await self._close_redis_tracking()
+
+        if self._index_dirty_keys:
+            await self._write_disk_cache_index()
+        await asyncio.to_thread(self._close_index_db)
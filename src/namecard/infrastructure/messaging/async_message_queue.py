@@ -13,14 +13,17 @@ Features:
 """
 
 import asyncio
-import hashlib
+import heapq
+import itertools
 import json
 import logging
+import sys
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
 from enum import IntEnum
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 
 class MessagePriority(IntEnum):
@@ -33,7 +36,14 @@ class MessagePriority(IntEnum):
     BATCH = 5  # 批次 - 合併處理
 
 
-@dataclass
+# 訊息ID序號（行程內遞增）
+_message_id_counter = itertools.count()
+
+# Python 3.10+ 以 __slots__ 建立訊息物件（無 __dict__，記憶體較小、屬性存取較快）
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class QueuedMessage:
     """佇列中的訊息物件"""
 
@@ -48,6 +58,7 @@ class QueuedMessage:
     parse_mode: Optional[str] = None
     context: Optional[str] = None  # 批次上下文
     message_type: Optional[str] = None  # 訊息類型
+    payload: Optional[Dict[str, Any]] = None  # 結構化資料（如名片摘要）
 
     # 內部屬性
     message_id: str = field(default="")
@@ -56,9 +67,10 @@ class QueuedMessage:
     def __post_init__(self):
         """初始化後處理"""
         if not self.message_id:
-            # 生成唯一訊息ID
-            content = f"{self.chat_id}:{self.text}:{self.created_at}"
-            self.message_id = hashlib.md5(content.encode()).hexdigest()[:12]
+            # 生成唯一訊息ID：毫秒時間戳 + 序號（不需雜湊整段訊息內容）
+            timestamp_ms = int(self.created_at * 1000) & 0xFFFFFFFF
+            sequence = next(_message_id_counter) & 0xFFFF
+            self.message_id = f"{timestamp_ms:08x}{sequence:04x}"
 
         # 生成批次合併鍵
         if self.priority == MessagePriority.BATCH:
@@ -66,13 +78,21 @@ class QueuedMessage:
 
     def _generate_batch_key(self) -> str:
         """生成批次合併鍵"""
-        # 基於用戶ID、訊息類型和上下文生成
-        key_parts = [str(self.chat_id)]
+        return self.build_batch_key(self.chat_id, self.message_type, self.context)
+
+    @staticmethod
+    def build_batch_key(
+        chat_id: Union[int, str],
+        message_type: Optional[str] = None,
+        context: Optional[str] = None,
+    ) -> str:
+        """基於用戶ID、訊息類型和上下文生成批次合併鍵"""
+        key_parts = [str(chat_id)]
 
-        if self.message_type:
-            key_parts.append(self.message_type)
-        if self.context:
-            key_parts.append(self.context)
+        if message_type:
+            key_parts.append(message_type)
+        if context:
+            key_parts.append(context)
 
         return ":".join(key_parts)
 
@@ -80,6 +100,9 @@ class QueuedMessage:
 class AsyncMessageQueue:
     """異步訊息佇列系統"""
 
+    # 有專屬合併語意的訊息類型（摘要/只保留最新），不走批次發送器
+    SEMANTIC_MERGE_TYPES = frozenset({"card_processing_complete", "batch_progress"})
+
     def __init__(
         self,
         max_queue_size: int = 10000,
@@ -87,6 +110,7 @@ class AsyncMessageQueue:
         batch_size: int = 5,
         batch_timeout: float = 2.0,
         enable_smart_merging: bool = True,
+        max_pending_batches: int = 1024,
     ):
         """
         初始化異步訊息佇列
@@ -97,6 +121,7 @@ class AsyncMessageQueue:
             batch_size: 批次處理大小
             batch_timeout: 批次超時時間（秒）
             enable_smart_merging: 啟用智能合併
+            max_pending_batches: 同時等待合併的批次上限，超過時新批次直接入隊
         """
         self.logger = logging.getLogger(__name__)
 
@@ -105,47 +130,60 @@ class AsyncMessageQueue:
         self.batch_size = batch_size
         self.batch_timeout = batch_timeout
         self.enable_smart_merging = enable_smart_merging
+        self.max_pending_batches = max_pending_batches
 
         # 多優先級佇列
         self.queues = {
             priority: asyncio.Queue(maxsize=max_queue_size)
             for priority in MessagePriority
         }
+        # 依優先級排序的佇列（預先展開，取訊息時不需迭代枚舉與查表）
+        self._ordered_queues = tuple(self.queues[p] for p in MessagePriority)
+        # 可取訊息計數信號：工作者阻塞等待，入佇列即喚醒，不再輪詢
+        self.message_signal = None  # 延遲創建，避免事件循環綁定問題
 
         # 動態併發控制
         self.min_workers = 3
         self.max_workers = 20
         self.current_workers = initial_concurrent_workers
-        self.worker_semaphore = None  # 延遲創建，避免事件循環綁定問題
-
-        # 統計和監控
-        self.stats = {
-            "total_enqueued": 0,
-            "total_processed": 0,
-            "total_failed": 0,
-            "total_merged": 0,
-            "current_queue_size": 0,
-            "worker_adjustments": 0,
-            "connection_pool_cleanups": 0,
-        }
-
-        # 效能監控
-        self.performance_window = []
-        self.error_rate_window = []
-        self.last_adjustment_time = time.time()
+        # 計數器 + Condition 取代 Semaphore，調整上限時不需重建物件
+        self.active_workers = 0
+        self.worker_condition = None  # 延遲創建，避免事件循環綁定問題
+
+        # 統計和監控（熱路徑直接累加整數屬性，stats 字典僅在讀取時組裝）
+        self._total_enqueued = 0
+        self._total_processed = 0
+        self._total_failed = 0
+        self._total_merged = 0
+        self._current_queue_size = 0
+        self._worker_adjustments = 0
+        self._connection_pool_cleanups = 0
+
+        # 效能監控（固定長度滑動窗口，超出時自動淘汰最舊項目）
+        self.performance_window = deque(maxlen=100)
+        # 最近 20 筆結果（1=失敗），並同步維護窗口內的錯誤數
+        self.error_rate_window = deque(maxlen=20)
+        self.recent_errors = 0
+        self.last_adjustment_time = time.monotonic()
         self.adjustment_cooldown = 30  # 30秒調整冷卻期
 
         # 批次合併暫存
         self.pending_batches = defaultdict(list)
-        self.batch_timers = {}
+        # 批次到期時間：單一背景任務依最小堆順序發送逾時批次，不再每批一個計時任務
+        self.batch_deadlines: Dict[str, float] = {}
+        self._batch_heap: List[Tuple[float, str]] = []
+        self._batch_sweeper_task: Optional[asyncio.Task] = None
 
-        # 工作者控制
+        # 工作者控制：單一調度器取訊息，處理任務在併發上限內派發
         self.workers = []
+        self._inflight_tasks = set()
         self.is_running = False
         self.shutdown_event = None  # 延遲創建，避免事件循環綁定問題
 
         # 訊息發送器（由外部設置）
         self.message_sender: Optional[Callable] = None
+        # 批次發送器（可選）：接收 [(chat_id, text, parse_mode), ...] 一次送出
+        self.bulk_message_sender: Optional[Callable] = None
 
         self.logger.info(f"✅ AsyncMessageQueue 初始化完成")
         self.logger.info(f"   - 初始併發工作者: {self.current_workers}")
@@ -154,43 +192,88 @@ class AsyncMessageQueue:
             f"   - 智能合併: {'啟用' if self.enable_smart_merging else '停用'}"
         )
 
+    @property
+    def stats(self) -> Dict[str, int]:
+        """統計計數快照（相容舊的 stats 字典介面）"""
+        return {
+            "total_enqueued": self._total_enqueued,
+            "total_processed": self._total_processed,
+            "total_failed": self._total_failed,
+            "total_merged": self._total_merged,
+            "current_queue_size": self._current_queue_size,
+            "worker_adjustments": self._worker_adjustments,
+            "connection_pool_cleanups": self._connection_pool_cleanups,
+        }
+
     def _get_shutdown_event(self):
         """安全獲取 shutdown_event，確保在正確的事件循環中創建"""
         if self.shutdown_event is None:
-            try:
-                # 獲取當前事件循環
-                current_loop = asyncio.get_running_loop()
-                self.shutdown_event = asyncio.Event()
-                self.logger.debug("🔧 在當前事件循環中創建 shutdown_event")
-            except RuntimeError:
-                # 沒有運行中的事件循環，創建新的 Event
-                self.shutdown_event = asyncio.Event()
-                self.logger.debug("🔧 創建新的 shutdown_event")
+            self.shutdown_event = asyncio.Event()
+            self.logger.debug("🔧 創建 shutdown_event")
         return self.shutdown_event
 
-    def _get_worker_semaphore(self):
-        """安全獲取 worker_semaphore，確保在正確的事件循環中創建"""
-        if self.worker_semaphore is None:
-            try:
-                # 獲取當前事件循環
-                current_loop = asyncio.get_running_loop()
-                self.worker_semaphore = asyncio.Semaphore(self.current_workers)
-                self.logger.debug(
-                    f"🔧 在當前事件循環中創建 worker_semaphore ({self.current_workers})"
-                )
-            except RuntimeError:
-                # 沒有運行中的事件循環，創建新的 Semaphore
-                self.worker_semaphore = asyncio.Semaphore(self.current_workers)
-                self.logger.debug(
-                    f"🔧 創建新的 worker_semaphore ({self.current_workers})"
-                )
-        return self.worker_semaphore
+    def _get_worker_condition(self):
+        """安全獲取 worker_condition，確保在正確的事件循環中創建"""
+        if self.worker_condition is None:
+            self.worker_condition = asyncio.Condition()
+            self.logger.debug(
+                "🔧 創建 worker_condition (上限 %s)", self.current_workers
+            )
+        return self.worker_condition
+
+    async def _acquire_worker_slot(self, abort_on_stop: bool = False) -> bool:
+        """
+        等待直到 active_workers < current_workers，並佔用一個槽位
+
+        Args:
+            abort_on_stop: 系統停止時放棄等待（調度器使用，避免 stop() 卡在槽位上）
+
+        Returns:
+            bool: 是否取得槽位
+        """
+        condition = self._get_worker_condition()
+        async with condition:
+            await condition.wait_for(
+                lambda: (abort_on_stop and not self.is_running)
+                or self.active_workers < self.current_workers
+            )
+            if abort_on_stop and not self.is_running:
+                return False
+            self.active_workers += 1
+            return True
+
+    async def _release_worker_slot(self):
+        """釋放槽位並喚醒一個等待者"""
+        condition = self._get_worker_condition()
+        async with condition:
+            self.active_workers -= 1
+            condition.notify(1)
+
+    @asynccontextmanager
+    async def _worker_slot(self):
+        """併發槽位：active_workers < current_workers 時才允許進入"""
+        await self._acquire_worker_slot()
+        try:
+            yield
+        finally:
+            await self._release_worker_slot()
+
+    def _get_message_signal(self):
+        """安全獲取 message_signal（計數 = 佇列中可取的訊息數）"""
+        if self.message_signal is None:
+            self.message_signal = asyncio.Semaphore(0)
+        return self.message_signal
 
     def set_message_sender(self, sender: Callable):
         """設置訊息發送器函數"""
         self.message_sender = sender
         self.logger.debug("✅ 訊息發送器已設置")
 
+    def set_bulk_message_sender(self, sender: Callable):
+        """設置批次訊息發送器函數"""
+        self.bulk_message_sender = sender
+        self.logger.debug("✅ 批次訊息發送器已設置")
+
     async def start(self):
         """啟動佇列處理系統"""
         if self.is_running:
@@ -198,19 +281,23 @@ class AsyncMessageQueue:
             return
 
         self.is_running = True
+        self._start_time = time.monotonic()
         self._get_shutdown_event().clear()
 
-        # 啟動工作者
-        for i in range(self.current_workers):
-            worker = asyncio.create_task(self._worker(f"worker-{i}"))
-            self.workers.append(worker)
+        # 在目前事件循環中預先建立同步原語，熱路徑只剩屬性讀取
+        self._get_message_signal()
+        self._get_worker_condition()
+
+        # 啟動調度器（併發度由 current_workers 控制，調整後立即生效）
+        dispatcher = asyncio.create_task(self._dispatch_loop())
+        self.workers.append(dispatcher)
 
         # 啟動監控任務
         monitor_task = asyncio.create_task(self._performance_monitor())
         self.workers.append(monitor_task)
 
         self.logger.info(f"🚀 異步訊息佇列系統已啟動")
-        self.logger.info(f"   - 工作者數量: {len(self.workers) - 1}")  # 減去監控任務
+        self.logger.info(f"   - 併發上限: {self.current_workers}")
 
     async def stop(self):
         """停止佇列處理系統"""
@@ -219,14 +306,25 @@ class AsyncMessageQueue:
         self.is_running = False
         self._get_shutdown_event().set()
 
-        # 等待所有工作者完成
+        # 喚醒阻塞等待訊息或槽位的調度器，讓它檢查停止狀態後退出
+        self._get_message_signal().release()
+        condition = self._get_worker_condition()
+        async with condition:
+            condition.notify_all()
+
+        # 等待調度器、監控任務及已派發的處理任務完成
         if self.workers:
             await asyncio.gather(*self.workers, return_exceptions=True)
             self.workers.clear()
+        if self._inflight_tasks:
+            await asyncio.gather(*self._inflight_tasks, return_exceptions=True)
 
         # 清理待處理的批次
         await self._flush_pending_batches()
 
+        if self._batch_sweeper_task and not self._batch_sweeper_task.done():
+            self._batch_sweeper_task.cancel()
+
         self.logger.info("✅ 異步訊息佇列系統已停止")
 
     async def enqueue_message(
@@ -238,6 +336,7 @@ class AsyncMessageQueue:
         context: Optional[str] = None,
         message_type: Optional[str] = None,
         max_retries: int = 3,
+        payload: Optional[Dict[str, Any]] = None,
     ) -> str:
         """
         將訊息加入佇列
@@ -254,41 +353,41 @@ class AsyncMessageQueue:
             context=context,
             message_type=message_type,
             max_retries=max_retries,
+            payload=payload,
         )
 
         # 緊急訊息直接發送，繞過排程
         if priority == MessagePriority.EMERGENCY:
-            self.logger.debug(f"🚨 緊急訊息直接發送: {message.message_id}")
+            self.logger.debug("🚨 緊急訊息直接發送: %s", message.message_id)
             if self.message_sender:
                 try:
                     await self.message_sender(chat_id, text, parse_mode)
-                    self.stats["total_processed"] += 1
+                    self._total_processed += 1
                     return message.message_id
                 except Exception as e:
                     self.logger.error(f"❌ 緊急訊息發送失敗: {e}")
-                    self.stats["total_failed"] += 1
-                    # 降級到高優先級佇列
-                    message.priority = MessagePriority.HIGH
-
-        # 檢查佇列容量
-        queue = self.queues[message.priority]
-        if queue.full():
-            self.logger.warning(
-                f"⚠️ 佇列已滿 ({message.priority.name})，丟棄訊息: {message.message_id}"
-            )
-            return message.message_id
+                    self._total_failed += 1
+                    # 改入緊急佇列：工作者每次取訊息都先檢查，不會排在高優先級之後
 
         # 批次訊息處理
         if priority == MessagePriority.BATCH and self.enable_smart_merging:
             await self._handle_batch_message(message)
         else:
-            # 直接加入佇列
-            await queue.put(message)
-            self.stats["total_enqueued"] += 1
-            self.stats["current_queue_size"] += 1
+            # 直接加入佇列：put_nowait 一次完成容量檢查與入隊
+            try:
+                self.queues[message.priority].put_nowait(message)
+            except asyncio.QueueFull:
+                self.logger.warning(
+                    f"⚠️ 佇列已滿 ({message.priority.name})，丟棄訊息: {message.message_id}"
+                )
+                return message.message_id
+
+            self._get_message_signal().release()
+            self._total_enqueued += 1
+            self._current_queue_size += 1
 
         self.logger.debug(
-            f"📥 訊息已加入佇列: {message.message_id} (優先級: {priority.name})"
+            "📥 訊息已加入佇列: %s (優先級: %s)", message.message_id, priority.name
         )
         return message.message_id
 
@@ -296,26 +395,58 @@ class AsyncMessageQueue:
         """處理批次訊息，實現智能合併"""
         batch_key = message.batch_key
 
+        # 待合併批次已達上限（大量不同 batch_key）：不再開新批次，改走普通佇列
+        if (
+            batch_key not in self.pending_batches
+            and len(self.pending_batches) >= self.max_pending_batches
+        ):
+            message.priority = MessagePriority.NORMAL
+            try:
+                self.queues[MessagePriority.NORMAL].put_nowait(message)
+            except asyncio.QueueFull:
+                self.logger.warning(
+                    f"⚠️ 佇列已滿 (NORMAL)，丟棄訊息: {message.message_id}"
+                )
+                return
+
+            self._get_message_signal().release()
+            self._total_enqueued += 1
+            self._current_queue_size += 1
+            return
+
         # 加入待處理批次
         self.pending_batches[batch_key].append(message)
 
-        # 設置批次定時器
-        if batch_key not in self.batch_timers:
-            timer = asyncio.create_task(self._batch_timer(batch_key))
-            self.batch_timers[batch_key] = timer
+        # 新批次：登記到期時間
+        if batch_key not in self.batch_deadlines:
+            deadline = time.monotonic() + self.batch_timeout
+            self.batch_deadlines[batch_key] = deadline
+            heapq.heappush(self._batch_heap, (deadline, batch_key))
+
+            if self._batch_sweeper_task is None or self._batch_sweeper_task.done():
+                self._batch_sweeper_task = asyncio.create_task(self._batch_sweeper())
 
         # 檢查是否達到批次大小
         if len(self.pending_batches[batch_key]) >= self.batch_size:
             await self._flush_batch(batch_key)
 
-    async def _batch_timer(self, batch_key: str):
-        """批次定時器，超時後自動發送"""
+    async def _batch_sweeper(self):
+        """批次到期掃描器，依到期順序發送逾時批次，堆空時結束"""
         try:
-            await asyncio.sleep(self.batch_timeout)
-            if batch_key in self.pending_batches:
-                await self._flush_batch(batch_key)
+            while self._batch_heap:
+                deadline, batch_key = self._batch_heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    # 逾時設定固定，新批次的到期時間不會早於堆頂
+                    await asyncio.sleep(delay)
+                    continue
+
+                heapq.heappop(self._batch_heap)
+                # 已提前發送（達到批次大小）的批次會留下過期項目，直接略過
+                if self.batch_deadlines.get(batch_key) == deadline:
+                    await self._flush_batch(batch_key)
         except asyncio.CancelledError:
-            pass  # 定時器被取消
+            pass  # 掃描器被取消
 
     async def _flush_batch(self, batch_key: str):
         """發送批次訊息"""
@@ -323,24 +454,50 @@ class AsyncMessageQueue:
             return
 
         messages = self.pending_batches.pop(batch_key)
+        self.batch_deadlines.pop(batch_key, None)
         if not messages:
             return
 
-        # 取消定時器
-        if batch_key in self.batch_timers:
-            self.batch_timers[batch_key].cancel()
-            del self.batch_timers[batch_key]
+        # 批次發送器：逐條原文一次送出，不合併成單一長訊息
+        if (
+            self.bulk_message_sender
+            and len(messages) > 1
+            and messages[0].message_type not in self.SEMANTIC_MERGE_TYPES
+        ):
+            if await self._send_bulk(messages):
+                return
 
         # 智能合併
         merged_message = self._merge_messages(messages)
         if merged_message:
             # 加入高優先級佇列快速處理
-            await self.queues[MessagePriority.HIGH].put(merged_message)
-            self.stats["total_enqueued"] += 1
-            self.stats["current_queue_size"] += 1
-            self.stats["total_merged"] += len(messages) - 1  # 合併數量
+            try:
+                self.queues[MessagePriority.HIGH].put_nowait(merged_message)
+            except asyncio.QueueFull:
+                self._total_failed += len(messages)
+                self.logger.warning(f"⚠️ 高優先級佇列已滿，丟棄合併訊息: {batch_key}")
+                return
+
+            self._get_message_signal().release()
+            self._total_enqueued += 1
+            self._current_queue_size += 1
+            self._total_merged += len(messages) - 1  # 合併數量
 
-            self.logger.debug(f"🔄 已合併 {len(messages)} 條批次訊息: {batch_key}")
+            self.logger.debug("🔄 已合併 %d 條批次訊息: %s", len(messages), batch_key)
+
+    async def _send_bulk(self, messages: List[QueuedMessage]) -> bool:
+        """透過批次發送器送出整批訊息，失敗時回傳 False 改走合併流程"""
+        try:
+            await self.bulk_message_sender(
+                [(msg.chat_id, msg.text, msg.parse_mode) for msg in messages]
+            )
+        except Exception as e:
+            self.logger.error(f"❌ 批次發送失敗，改用合併訊息: {e}")
+            return False
+
+        self._total_processed += len(messages)
+        self.logger.debug("📦 已批次發送 %d 條訊息", len(messages))
+        return True
 
     def _merge_messages(self, messages: List[QueuedMessage]) -> Optional[QueuedMessage]:
         """智能合併多條訊息"""
@@ -371,30 +528,26 @@ class AsyncMessageQueue:
         base_message = messages[0]
         count = len(messages)
 
-        # 提取名片資訊
+        # 提取名片資訊：優先使用生產端提供的 payload，無需掃描文字
         cards = []
         for msg in messages:
-            # 簡單解析名片資訊（實際實作會更複雜）
-            if "👤" in msg.text and "(" in msg.text:
+            if msg.payload and msg.payload.get("display"):
+                cards.append(msg.payload["display"])
+            elif "👤" in msg.text and "(" in msg.text:
+                # 舊呼叫端：從文字中取出 👤 該行
                 start = msg.text.find("👤") + 2
-                end = (
-                    msg.text.find("\n", start)
-                    if "\n" in msg.text[start:]
-                    else len(msg.text)
-                )
-                card_info = msg.text[start : start + end].strip()
-                cards.append(card_info)
+                cards.append(msg.text[start:].partition("\n")[0].strip())
 
-        # 生成合併訊息
-        merged_text = f"📊 **批次處理完成**\n\n"
-        merged_text += f"✅ 已處理 {count} 張名片：\n"
-        for i, card in enumerate(cards[:5], 1):  # 最多顯示5張
-            merged_text += f"{i}. {card}\n"
+        # 生成合併訊息：先收集片段再一次 join
+        parts = ["📊 **批次處理完成**\n\n", f"✅ 已處理 {count} 張名片：\n"]
+        # 最多顯示5張
+        parts.extend(f"{i}. {card}\n" for i, card in enumerate(cards[:5], 1))
 
         if len(cards) > 5:
-            merged_text += f"... 以及其他 {len(cards) - 5} 張名片\n"
+            parts.append(f"... 以及其他 {len(cards) - 5} 張名片\n")
 
-        merged_text += f"\n⏱️ 處理時間: {time.time() - base_message.created_at:.1f}秒"
+        parts.append(f"\n⏱️ 處理時間: {time.time() - base_message.created_at:.1f}秒")
+        merged_text = "".join(parts)
 
         return QueuedMessage(
             chat_id=base_message.chat_id,
@@ -413,11 +566,11 @@ class AsyncMessageQueue:
             # 少量訊息直接組合
             combined_text = "\n\n".join(msg.text for msg in messages)
         else:
-            # 大量訊息摘要
-            combined_text = f"📝 **批次訊息摘要** ({len(messages)} 條)\n\n"
-            combined_text += "\n".join(f"• {msg.text[:50]}..." for msg in messages[:3])
-            if len(messages) > 3:
-                combined_text += f"\n... 以及其他 {len(messages) - 3} 條訊息"
+            # 大量訊息摘要（此分支必有超過 3 條）
+            parts = [f"📝 **批次訊息摘要** ({len(messages)} 條)\n"]
+            parts.extend(f"\n• {msg.text[:50]}..." for msg in messages[:3])
+            parts.append(f"\n... 以及其他 {len(messages) - 3} 條訊息")
+            combined_text = "".join(parts)
 
         return QueuedMessage(
             chat_id=base_message.chat_id,
@@ -433,49 +586,56 @@ class AsyncMessageQueue:
         for batch_key in list(self.pending_batches.keys()):
             await self._flush_batch(batch_key)
 
-    async def _worker(self, worker_name: str):
-        """工作者協程，處理佇列中的訊息"""
-        self.logger.debug(f"🔧 工作者已啟動: {worker_name}")
+    async def _dispatch_loop(self):
+        """調度器協程：在併發上限內取出訊息並派發處理任務"""
+        self.logger.debug("🔧 調度器已啟動")
 
         while self.is_running:
             try:
-                # 按優先級處理訊息
+                # 先佔槽位再取訊息：槽位滿時不提前取出，後到的高優先級訊息仍可插隊
+                if not await self._acquire_worker_slot(abort_on_stop=True):
+                    break
                 message = await self._get_next_message()
 
                 if message is None:
-                    # 沒有訊息，短暫休息
-                    await asyncio.sleep(0.1)
+                    # 停止時的喚醒信號
+                    await self._release_worker_slot()
                     continue
 
-                # 併發控制
-                async with self._get_worker_semaphore():
-                    await self._process_message(message, worker_name)
+                task = asyncio.create_task(self._run_message(message))
+                self._inflight_tasks.add(task)
+                task.add_done_callback(self._inflight_tasks.discard)
 
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                self.logger.error(f"❌ 工作者 {worker_name} 發生錯誤: {e}")
+                self.logger.error(f"❌ 調度器發生錯誤: {e}")
                 await asyncio.sleep(1)  # 錯誤後暫停
 
-        self.logger.debug(f"🛑 工作者已停止: {worker_name}")
+        self.logger.debug("🛑 調度器已停止")
+
+    async def _run_message(self, message: QueuedMessage):
+        """處理單條訊息，完成後歸還併發槽位"""
+        try:
+            await self._process_message(message, "dispatcher")
+        finally:
+            await self._release_worker_slot()
 
     async def _get_next_message(self) -> Optional[QueuedMessage]:
-        """按優先級獲取下一條訊息"""
+        """按優先級獲取下一條訊息（佇列皆空時等待新訊息）"""
+        await self._get_message_signal().acquire()
+
         # 按優先級順序檢查佇列
-        for priority in MessagePriority:
-            queue = self.queues[priority]
-            try:
-                message = queue.get_nowait()
-                self.stats["current_queue_size"] -= 1
-                return message
-            except asyncio.QueueEmpty:
-                continue
+        for queue in self._ordered_queues:
+            if not queue.empty():
+                self._current_queue_size -= 1
+                return queue.get_nowait()
 
         return None
 
     async def _process_message(self, message: QueuedMessage, worker_name: str):
         """處理單條訊息"""
-        start_time = time.time()
+        start_time = time.monotonic()
 
         try:
             if not self.message_sender:
@@ -485,20 +645,21 @@ class AsyncMessageQueue:
             await self.message_sender(message.chat_id, message.text, message.parse_mode)
 
             # 記錄成功
-            processing_time = time.time() - start_time
-            self.performance_window.append(processing_time)
-            self.error_rate_window.append(0)  # 成功
-            self.stats["total_processed"] += 1
+            processing_time = time.monotonic() - start_time
+            self._record_outcome(processing_time, failed=False)
+            self._total_processed += 1
 
             self.logger.debug(
-                f"✅ 訊息處理成功: {message.message_id} ({processing_time:.2f}s) - {worker_name}"
+                "✅ 訊息處理成功: %s (%.2fs) - %s",
+                message.message_id,
+                processing_time,
+                worker_name,
             )
 
         except Exception as e:
             # 記錄失敗
-            processing_time = time.time() - start_time
-            self.performance_window.append(processing_time)
-            self.error_rate_window.append(1)  # 失敗
+            processing_time = time.monotonic() - start_time
+            self._record_outcome(processing_time, failed=True)
 
             self.logger.error(f"❌ 訊息處理失敗: {message.message_id} - {e}")
 
@@ -512,30 +673,42 @@ class AsyncMessageQueue:
                     f"🔄 訊息重試 {message.retry_count}/{message.max_retries} (延遲 {retry_delay}s): {message.message_id}"
                 )
 
-                # 延遲後重新加入佇列
-                asyncio.create_task(self._retry_message(message, retry_delay))
+                # 延遲後重新加入佇列：只排一個計時器，不為每次重試建立任務
+                asyncio.get_running_loop().call_later(
+                    retry_delay, self._requeue_retry, message
+                )
             else:
-                self.stats["total_failed"] += 1
+                self._total_failed += 1
                 self.logger.error(f"💀 訊息最終失敗: {message.message_id}")
 
-        # 限制效能窗口大小
-        if len(self.performance_window) > 100:
-            self.performance_window = self.performance_window[-50:]
-        if len(self.error_rate_window) > 100:
-            self.error_rate_window = self.error_rate_window[-50:]
+    def _record_outcome(self, processing_time: float, failed: bool):
+        """記錄處理結果，錯誤數隨窗口淘汰增減，無需重新加總"""
+        self.performance_window.append(processing_time)
 
-    async def _retry_message(self, message: QueuedMessage, delay: float):
-        """延遲重試訊息"""
-        await asyncio.sleep(delay)
-        if self.is_running:
-            # 降低優先級重新加入佇列
-            if message.priority.value < MessagePriority.LOW.value:
-                message.priority = MessagePriority(message.priority.value + 1)
+        if len(self.error_rate_window) == self.error_rate_window.maxlen:
+            self.recent_errors -= self.error_rate_window[0]
+
+        outcome = 1 if failed else 0
+        self.error_rate_window.append(outcome)
+        self.recent_errors += outcome
+
+    def _requeue_retry(self, message: QueuedMessage):
+        """重試計時器到期：降低優先級後重新加入佇列（佇列已滿則放棄本次重試）"""
+        if not self.is_running:
+            return
 
-            queue = self.queues[message.priority]
-            if not queue.full():
-                await queue.put(message)
-                self.stats["current_queue_size"] += 1
+        if message.priority < MessagePriority.LOW:
+            message.priority = MessagePriority(message.priority + 1)
+
+        try:
+            self.queues[message.priority].put_nowait(message)
+        except asyncio.QueueFull:
+            self._total_failed += 1
+            self.logger.warning(f"⚠️ 佇列已滿，放棄重試: {message.message_id}")
+            return
+
+        self._get_message_signal().release()
+        self._current_queue_size += 1
 
     async def _performance_monitor(self):
         """效能監控和動態調整"""
@@ -547,14 +720,14 @@ class AsyncMessageQueue:
 
                 # 計算效能指標
                 if len(self.error_rate_window) >= 10:
-                    recent_errors = self.error_rate_window[-20:]
-                    error_rate = sum(recent_errors) / len(recent_errors)
+                    error_rate = self.recent_errors / len(self.error_rate_window)
 
                     # 動態調整併發數
                     await self._adjust_concurrency(error_rate)
 
-                # 記錄統計
-                self.logger.debug(f"📈 佇列統計: {self._get_queue_stats()}")
+                # 記錄統計（僅在 DEBUG 開啟時才彙整）
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("📈 佇列統計: %s", self._get_queue_stats())
 
             except asyncio.CancelledError:
                 break
@@ -565,7 +738,7 @@ class AsyncMessageQueue:
 
     async def _adjust_concurrency(self, error_rate: float):
         """根據錯誤率動態調整併發數"""
-        current_time = time.time()
+        current_time = time.monotonic()
 
         # 檢查調整冷卻期
         if current_time - self.last_adjustment_time < self.adjustment_cooldown:
@@ -576,33 +749,21 @@ class AsyncMessageQueue:
         if error_rate > 0.3:  # 錯誤率 > 30%
             # 降低併發數
             new_workers = max(self.min_workers, self.current_workers - 2)
-        elif (
-            error_rate < 0.1
-            and self.stats["total_processed"] > self.current_workers * 20
-        ):
+        elif error_rate < 0.1 and self._total_processed > self.current_workers * 20:
             # 錯誤率 < 10% 且處理量足夠，增加併發數
             new_workers = min(self.max_workers, self.current_workers + 1)
         else:
             return  # 不需要調整
 
         if new_workers != old_workers:
-            self.current_workers = new_workers
-
-            # 更新 Semaphore（創建新的，因為 asyncio.Semaphore 不支援動態調整）
-            try:
-                # 獲取當前事件循環
-                current_loop = asyncio.get_running_loop()
-                self.worker_semaphore = asyncio.Semaphore(new_workers)
-                self.logger.debug(
-                    f"🔧 在當前事件循環中重建 worker_semaphore ({new_workers})"
-                )
-            except RuntimeError:
-                # 沒有運行中的事件循環，創建新的 Semaphore
-                self.worker_semaphore = asyncio.Semaphore(new_workers)
-                self.logger.debug(f"🔧 重建 worker_semaphore ({new_workers})")
+            # 原地調整上限並喚醒等待者；持有槽位的工作者不受影響
+            condition = self._get_worker_condition()
+            async with condition:
+                self.current_workers = new_workers
+                condition.notify_all()
 
             self.last_adjustment_time = current_time
-            self.stats["worker_adjustments"] += 1
+            self._worker_adjustments += 1
 
             self.logger.info(
                 f"🔧 併發數調整: {old_workers} → {new_workers} (錯誤率: {error_rate:.1%})"
@@ -617,13 +778,13 @@ class AsyncMessageQueue:
         return {
             "queue_sizes": queue_sizes,
             "current_workers": self.current_workers,
-            "total_enqueued": self.stats["total_enqueued"],
-            "total_processed": self.stats["total_processed"],
-            "total_failed": self.stats["total_failed"],
-            "total_merged": self.stats["total_merged"],
+            "total_enqueued": self._total_enqueued,
+            "total_processed": self._total_processed,
+            "total_failed": self._total_failed,
+            "total_merged": self._total_merged,
             "pending_batches": len(self.pending_batches),
             "error_rate": (
-                sum(self.error_rate_window[-20:]) / len(self.error_rate_window[-20:])
+                self.recent_errors / len(self.error_rate_window)
                 if len(self.error_rate_window) >= 20
                 else 0
             ),
@@ -643,7 +804,7 @@ class AsyncMessageQueue:
         return {
             "status": "healthy" if is_healthy else "degraded",
             "is_running": self.is_running,
-            "uptime": time.time() - getattr(self, "_start_time", time.time()),
+            "uptime": time.monotonic() - getattr(self, "_start_time", time.monotonic()),
             "statistics": stats,
             "recommendations": self._get_health_recommendations(stats),
         }
@@ -677,13 +838,17 @@ class BatchContext:
         self.queue = queue
         self.context_name = context_name
         self.message_count = 0
+        # 本上下文產生的批次鍵，退出時只發送自己的批次
+        self.batch_keys = set()
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        # 強制發送待處理的批次
-        await self.queue._flush_pending_batches()
+        # 強制發送本上下文待處理的批次，不影響其他並行的上下文
+        for batch_key in self.batch_keys:
+            await self.queue._flush_batch(batch_key)
+        self.batch_keys.clear()
 
     async def send_message(
         self,
@@ -694,6 +859,9 @@ class BatchContext:
     ) -> str:
         """在批次上下文中發送訊息"""
         self.message_count += 1
+        self.batch_keys.add(
+            QueuedMessage.build_batch_key(chat_id, message_type, self.context_name)
+        )
 
         return await self.queue.enqueue_message(
             chat_id=chat_id,
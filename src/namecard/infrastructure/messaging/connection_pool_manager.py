@@ -13,15 +13,43 @@
 
 import asyncio
 import logging
+import random
+import sys
 import time
-import weakref
+from collections import Counter, defaultdict
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Set, Union
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
 from urllib.parse import urlparse
 
 import aiohttp
 
+# 下載時每次讀取的分塊大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 共用下載的鍵值：(URL, session_key, max_retries)
+DownloadKey = Tuple[str, str, Optional[int]]
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 標頭（秒數或 HTTP 日期），無法解析時返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
 
 @dataclass
 class ConnectionPoolConfig:
@@ -30,6 +58,8 @@ class ConnectionPoolConfig:
     # 基本連接限制
     total_limit: int = 25
     per_host_limit: int = 8
+    # 批次下載分片數：>1 時 URL 輪流分配到多個 session，同主機可用連接數隨之倍增
+    pool_shards: int = 1
 
     # 超時設置
     total_timeout: int = 20
@@ -47,13 +77,18 @@ class ConnectionPoolConfig:
     # 重試設置
     max_retries: int = 3
     retry_backoff: float = 1.0
+    max_backoff: float = 30.0
 
     # DNS 優化
     use_dns_cache: bool = True
     dns_cache_ttl: int = 300
 
 
-@dataclass
+# Python 3.10+ 以 __slots__ 建立統計物件，計數器累加走 slot 而非實例字典
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class ConnectionStats:
     """連接統計"""
 
@@ -76,8 +111,14 @@ class ConnectionPoolManager:
 
         # 連接池實例管理
         self._sessions: Dict[str, aiohttp.ClientSession] = {}
-        self._session_locks: Dict[str, asyncio.Lock] = {}
-        self._session_refs = weakref.WeakSet()
+        # 首次存取時才建立鎖（在執行中的事件循環內）
+        self._session_locks: DefaultDict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # 所有 session 共用的 DNS 解析器，首次建立 session 時創建
+        self._resolver: Optional[aiohttp.abc.AbstractResolver] = None
+        # 進行中的下載，相同請求併發時共用結果
+        self._inflight_downloads: Dict[DownloadKey, asyncio.Task] = {}
+        # 每個下載任務目前的等待者數，歸零時取消任務
+        self._download_waiters: Dict[asyncio.Task, int] = {}
 
         # 統計和監控
         self.stats = ConnectionStats()
@@ -97,20 +138,25 @@ class ConnectionPoolManager:
 
     async def get_session(self, session_key: str = "default") -> aiohttp.ClientSession:
         """獲取優化的 HTTP 會話（單例模式）"""
-        if session_key not in self._sessions:
-            if session_key not in self._session_locks:
-                self._session_locks[session_key] = asyncio.Lock()
+        # 快速路徑：已有可用 session 時只做一次字典查找，不取鎖
+        session = self._sessions.get(session_key)
+        if session is not None and not session.closed:
+            return session
 
-            async with self._session_locks[session_key]:
-                if session_key not in self._sessions:
-                    session = await self._create_optimized_session()
-                    self._sessions[session_key] = session
-                    self._session_refs.add(session)
+        return await self._create_session(session_key)
 
-                    self.stats.total_created += 1
-                    self.logger.debug(f"✅ 新建 HTTP Session: {session_key}")
+    async def _create_session(self, session_key: str) -> aiohttp.ClientSession:
+        """慢速路徑：在鎖內建立（或重建已關閉的）session"""
+        async with self._session_locks[session_key]:
+            session = self._sessions.get(session_key)
+            if session is None or session.closed:
+                session = await self._create_optimized_session()
+                self._sessions[session_key] = session
 
-        return self._sessions[session_key]
+                self.stats.total_created += 1
+                self.logger.debug("✅ 新建 HTTP Session: %s", session_key)
+
+        return session
 
     async def _create_optimized_session(self) -> aiohttp.ClientSession:
         """創建優化的 HTTP 會話"""
@@ -128,6 +174,11 @@ class ConnectionPoolManager:
             "force_close": False,  # 避免強制關閉連接
         }
 
+        # 共用解析器：避免每個 session 各自建立解析器
+        if self._resolver is None:
+            self._resolver = aiohttp.DefaultResolver()
+        connector_config["resolver"] = self._resolver
+
         connector = aiohttp.TCPConnector(**connector_config)
 
         # 超時配置 - 修復超時問題
@@ -167,8 +218,12 @@ class ConnectionPoolManager:
 
             try:
                 async with session.request(method, url, **kwargs) as response:
+                    # 只有真正建立連線的請求才計入，連線失敗時不需再校正
                     self.stats.active_connections += 1
-                    yield response
+                    try:
+                        yield response
+                    finally:
+                        self.stats.active_connections -= 1
 
             except asyncio.TimeoutError:
                 self.stats.total_timeouts += 1
@@ -181,9 +236,6 @@ class ConnectionPoolManager:
                 raise
 
             finally:
-                self.stats.active_connections = max(
-                    0, self.stats.active_connections - 1
-                )
                 duration = time.time() - start_time
                 if duration > 5.0:  # 警告慢請求
                     self.logger.warning(f"🐌 慢請求: {url} ({duration:.2f}s)")
@@ -192,8 +244,52 @@ class ConnectionPoolManager:
         self, url: str, max_retries: Optional[int] = None, session_key: str = "default"
     ) -> Dict[str, Any]:
         """帶重試機制的下載 - 修復不穩定連接問題"""
+        # 相同請求已在下載中：等待同一個任務，不重複發出請求
+        key = (url, session_key, max_retries)
+        task = self._inflight_downloads.get(key)
+        if task is None or task.done():
+            task = asyncio.create_task(
+                self._download_with_retry(url, max_retries, session_key)
+            )
+            self._inflight_downloads[key] = task
+            task.add_done_callback(lambda done: self._finish_download(key, done))
+
+        # shield：單一呼叫者被取消時不影響其他等待者；
+        # 最後一個等待者離開時才取消下載，避免呼叫端放棄後仍在背景重試
+        self._download_waiters[task] = self._download_waiters.get(task, 0) + 1
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            self._download_waiters[task] -= 1
+            if not self._download_waiters[task]:
+                del self._download_waiters[task]
+                if not task.done():
+                    task.cancel()
+                    if self._inflight_downloads.get(key) is task:
+                        del self._inflight_downloads[key]
+
+        # 每個呼叫者取得各自的結果字典
+        return dict(result)
+
+    def _finish_download(self, key: DownloadKey, task: asyncio.Task) -> None:
+        """下載任務完成：移出進行中清單，多個等待者共用時資料改為不可變的 bytes"""
+        if self._inflight_downloads.get(key) is task:
+            del self._inflight_downloads[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        # 在任何等待者恢復執行前轉換，避免其中一人修改緩衝區影響其他人
+        result = task.result()
+        if self._download_waiters.get(task, 0) > 1 and "data" in result:
+            result["data"] = bytes(result["data"])
+
+    async def _download_with_retry(
+        self, url: str, max_retries: Optional[int], session_key: str
+    ) -> Dict[str, Any]:
+        """實際的下載與重試流程"""
         max_retries = max_retries or self.config.max_retries
         last_error = None
+        delay = self.config.retry_backoff
 
         for attempt in range(max_retries + 1):
             try:
@@ -201,7 +297,12 @@ class ConnectionPoolManager:
                     url, session_key=session_key
                 ) as response:
                     if response.status == 200:
-                        data = await response.read()
+                        # 分塊讀入同一個 bytearray，不再保留所有分塊後整體複製一次
+                        data = bytearray()
+                        async for chunk in response.content.iter_chunked(
+                            DOWNLOAD_CHUNK_SIZE
+                        ):
+                            data += chunk
                         return {
                             "success": True,
                             "data": data,
@@ -214,17 +315,36 @@ class ConnectionPoolManager:
                             request_info=response.request_info,
                             history=response.history,
                             status=response.status,
+                            headers=response.headers,
                         )
 
             except Exception as e:
                 last_error = e
 
                 if attempt < max_retries:
-                    # 指數退避重試
-                    delay = self.config.retry_backoff * (2**attempt)
+                    retry_after = None
+                    if (
+                        isinstance(e, aiohttp.ClientResponseError)
+                        and e.status == 429
+                        and e.headers
+                    ):
+                        retry_after = _parse_retry_after(e.headers.get("Retry-After"))
+
+                    if retry_after is not None:
+                        # 限流時依伺服器指定的等待時間重試（仍受上限約束）
+                        delay = min(self.config.max_backoff, retry_after)
+                    else:
+                        # 去相關抖動退避：多個下載同時失敗時不會同步重試
+                        delay = min(
+                            self.config.max_backoff,
+                            random.uniform(self.config.retry_backoff, delay * 3),
+                        )
                     self.logger.debug(
-                        f"🔄 重試 {attempt + 1}/{max_retries}: {url} "
-                        f"(延遲 {delay:.1f}s)"
+                        "🔄 重試 %d/%d: %s (延遲 %.1fs)",
+                        attempt + 1,
+                        max_retries,
+                        url,
+                        delay,
                     )
                     await asyncio.sleep(delay)
                 else:
@@ -248,18 +368,67 @@ class ConnectionPoolManager:
             f"🚀 開始批次下載 {len(urls)} 個 URL (並發度: {max_concurrent})"
         )
 
-        # 創建信號量控制並發
-        semaphore = asyncio.Semaphore(max_concurrent)
+        # 重複的 URL 只下載一次（保留首次出現順序），結果再依原順序展開
+        unique_urls = list(dict.fromkeys(urls))
 
-        async def download_with_semaphore(url: str) -> Dict[str, Any]:
-            async with semaphore:
-                return await self.download_with_retry(url, session_key=session_key)
-
-        # 並行執行所有下載
+        # 滑動窗口：同時只保留 max_concurrent 個下載任務，完成一個補一個
         start_time = time.time()
-        results = await asyncio.gather(
-            *[download_with_semaphore(url) for url in urls], return_exceptions=True
-        )
+        unique_results: List[Any] = [None] * len(unique_urls)
+        pending: Dict[asyncio.Task, int] = {}
+        window = max(1, max_concurrent)
+        shards = max(1, self.config.pool_shards)
+        next_index = 0
+
+        try:
+            while pending or next_index < len(unique_urls):
+                while len(pending) < window and next_index < len(unique_urls):
+                    shard_key = (
+                        session_key
+                        if shards == 1
+                        else f"{session_key}_{next_index % shards}"
+                    )
+                    task = asyncio.create_task(
+                        self.download_with_retry(
+                            unique_urls[next_index], session_key=shard_key
+                        )
+                    )
+                    pending[task] = next_index
+                    next_index += 1
+
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    index = pending.pop(task)
+                    if task.cancelled():
+                        # 子任務被取消（CancelledError 不是 Exception，不能直接取結果）
+                        unique_results[index] = {
+                            "success": False,
+                            "error": "下載已取消",
+                            "url": unique_urls[index],
+                        }
+                    else:
+                        unique_results[index] = task.exception() or task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        # 重複位置各自取得一份結果字典，共用的資料改為不可變的 bytes，
+        # 呼叫端修改其中一份不影響其他位置
+        if len(unique_urls) < len(urls):
+            url_counts = Counter(urls)
+            for url, result in zip(unique_urls, unique_results):
+                if (
+                    url_counts[url] > 1
+                    and isinstance(result, dict)
+                    and "data" in result
+                ):
+                    result["data"] = bytes(result["data"])
+        result_by_url = dict(zip(unique_urls, unique_results))
+        results = [
+            dict(result) if isinstance(result, dict) else result
+            for result in (result_by_url[url] for url in urls)
+        ]
 
         # 處理結果
         processed_results = []
@@ -297,13 +466,8 @@ class ConnectionPoolManager:
         session_stats = {}
         for key, session in self._sessions.items():
             if hasattr(session.connector, "_conns"):
-                active = len(
-                    [
-                        conn
-                        for conns in session.connector._conns.values()
-                        for conn in conns
-                    ]
-                )
+                # 只加總各主機的連接數，不展開成中間串列
+                active = sum(len(conns) for conns in session.connector._conns.values())
                 session_stats[key] = {
                     "active_connections": active,
                     "closed": session.closed,
@@ -340,8 +504,7 @@ class ConnectionPoolManager:
             if session.closed:
                 # 移除已關閉的 session
                 del self._sessions[session_key]
-                if session_key in self._session_locks:
-                    del self._session_locks[session_key]
+                self._session_locks.pop(session_key, None)
                 cleanup_count += 1
                 self.stats.total_closed += 1
                 continue
@@ -377,6 +540,13 @@ class ConnectionPoolManager:
 
         self._sessions.clear()
         self._session_locks.clear()
+
+        if self._resolver is not None:
+            try:
+                await self._resolver.close()
+            except Exception as e:
+                self.logger.warning(f"關閉 DNS 解析器失敗: {e}")
+            self._resolver = None
         self.logger.info("✅ 所有連接池已清理")
 
     async def start_background_cleanup(self):
@@ -417,11 +587,6 @@ class ConnectionPoolManager:
 
         self.logger.info("✅ 連接池管理器已關閉")
 
-    def __del__(self):
-        """析構函數 - 確保資源釋放"""
-        if not self._shutdown and self._sessions:
-            self.logger.warning("⚠️ ConnectionPoolManager 未正確關閉，存在資源洩漏風險")
-
 
 # 全域連接池管理器實例
 _global_pool_manager: Optional[ConnectionPoolManager] = None
@@ -5,6 +5,7 @@
 """
 
 import asyncio
+import sys
 import time
 from typing import Any, Dict, List
 from unittest.mock import AsyncMock, MagicMock, patch
@@ -107,7 +108,17 @@ class TestAsyncMessageQueue:
         assert message.retry_count == 0
         assert message.max_retries == 3
         assert message.message_id != ""
-        assert len(message.message_id) == 12  # MD5 hash 前12位
+        assert len(message.message_id) == 12  # 時間戳 8 位 + 序號 4 位
+
+    @pytest.mark.skipif(sys.version_info < (3, 10), reason="需要 dataclass slots")
+    def test_queued_message_uses_slots(self):
+        """測試佇列訊息物件使用 __slots__，不帶 __dict__"""
+        message = QueuedMessage(12345, "測試", MessagePriority.BATCH)
+
+        assert not hasattr(message, "__dict__")
+        assert message.batch_key == "12345"
+        with pytest.raises(AttributeError):
+            message.unexpected = True
 
     def test_batch_key_generation(self):
         """測試批次鍵生成"""
@@ -195,9 +206,21 @@ class TestAsyncMessageQueue:
             chat_id=12345, text="緊急通知", priority=MessagePriority.EMERGENCY
         )
 
-        # 發送失敗，應該降級到高優先級佇列
+        # 發送失敗，應該進入緊急佇列等待工作者優先處理
         assert queue.stats["total_failed"] == 1
-        assert queue.queues[MessagePriority.HIGH].qsize() == 1
+        assert queue.queues[MessagePriority.EMERGENCY].qsize() == 1
+        assert queue.queues[MessagePriority.HIGH].qsize() == 0
+
+    async def test_failed_emergency_preempts_queued_high(self, message_queue):
+        """測試發送失敗的緊急訊息排在已佇列的高優先級訊息之前"""
+        queue, mock_sender = message_queue
+
+        await queue.enqueue_message(12345, "高優先級", MessagePriority.HIGH)
+        mock_sender.side_effect = Exception("發送失敗")
+        await queue.enqueue_message(12345, "緊急通知", MessagePriority.EMERGENCY)
+
+        first = await queue._get_next_message()
+        assert first.text == "緊急通知"
 
     async def test_queue_full_handling(self, message_queue):
         """測試佇列滿載處理"""
@@ -207,7 +230,7 @@ class TestAsyncMessageQueue:
         normal_queue = queue.queues[MessagePriority.NORMAL]
 
         # 模擬佇列已滿
-        with patch.object(normal_queue, "full", return_value=True):
+        with patch.object(normal_queue, "put_nowait", side_effect=asyncio.QueueFull):
             message_id = await queue.enqueue_message(
                 chat_id=12345, text="測試訊息", priority=MessagePriority.NORMAL
             )
@@ -262,6 +285,37 @@ class TestAsyncMessageQueue:
             or len(queue.pending_batches[batch_key]) == 0
         )
 
+    async def test_batch_timeouts_share_one_sweeper(self, message_queue):
+        """測試多個批次共用單一到期掃描任務，且提前發送的批次不會被重複處理"""
+        queue, mock_sender = message_queue
+
+        for chat_id in range(5):
+            await queue.enqueue_message(
+                chat_id=chat_id,
+                text="批次訊息",
+                priority=MessagePriority.BATCH,
+                message_type="test_batch",
+            )
+        sweeper = queue._batch_sweeper_task
+        assert sweeper is not None
+
+        # 第一個批次達到批次大小，提前發送後重新開始收集
+        for _ in range(queue.batch_size):
+            await queue.enqueue_message(
+                chat_id=0,
+                text="批次訊息",
+                priority=MessagePriority.BATCH,
+                message_type="test_batch",
+            )
+        assert queue._batch_sweeper_task is sweeper
+        assert len(queue.pending_batches["0:test_batch"]) == 1
+
+        await asyncio.sleep(1.2)
+
+        assert not queue.pending_batches
+        assert not queue.batch_deadlines
+        assert sweeper.done()
+
     async def test_card_processing_message_merging(self, message_queue):
         """測試名片處理訊息智能合併"""
         queue, mock_sender = message_queue
@@ -299,6 +353,27 @@ class TestAsyncMessageQueue:
         assert "張三" in merged.text
         assert "李四" in merged.text
         assert "王五" in merged.text
+        assert "1. 張三 (ABC公司)\n2." in merged.text
+
+    async def test_card_processing_merge_uses_payload(self, message_queue):
+        """測試名片合併優先使用結構化 payload"""
+        queue, mock_sender = message_queue
+
+        messages = [
+            QueuedMessage(
+                chat_id=12345,
+                text="📱 名片處理完成",
+                priority=MessagePriority.BATCH,
+                message_type="card_processing_complete",
+                payload={"display": f"名片 {i} (公司 {i})"},
+            )
+            for i in range(2)
+        ]
+
+        merged = queue._merge_card_processing_messages(messages)
+
+        assert "1. 名片 0 (公司 0)\n" in merged.text
+        assert "2. 名片 1 (公司 1)\n" in merged.text
 
     async def test_default_message_merging(self, message_queue):
         """測試默認訊息合併策略"""
@@ -330,6 +405,50 @@ class TestAsyncMessageQueue:
         assert "**批次訊息摘要** (5 條)" in merged_many.text
         assert "其他 2 條訊息" in merged_many.text
 
+    async def test_bulk_sender_flushes_batch_without_merging(self, message_queue):
+        """測試設置批次發送器後，批次訊息逐條原文一次送出"""
+        queue, mock_sender = message_queue
+        bulk_sender = AsyncMock()
+        queue.set_bulk_message_sender(bulk_sender)
+
+        for i in range(3):
+            await queue.enqueue_message(
+                chat_id=12345,
+                text=f"批次訊息 {i}",
+                priority=MessagePriority.BATCH,
+                message_type="test_batch",
+            )
+
+        bulk_sender.assert_awaited_once_with(
+            [(12345, f"批次訊息 {i}", None) for i in range(3)]
+        )
+        assert queue.stats["total_processed"] == 3
+        assert queue.queues[MessagePriority.HIGH].qsize() == 0
+
+    async def test_bulk_sender_failure_falls_back_to_merge(self, message_queue):
+        """測試批次發送失敗時改走合併流程，摘要類型不使用批次發送"""
+        queue, mock_sender = message_queue
+        bulk_sender = AsyncMock(side_effect=Exception("批次發送失敗"))
+        queue.set_bulk_message_sender(bulk_sender)
+
+        for i in range(3):
+            await queue.enqueue_message(
+                chat_id=12345,
+                text=f"批次訊息 {i}",
+                priority=MessagePriority.BATCH,
+                message_type="test_batch",
+            )
+        for i in range(3):
+            await queue.enqueue_message(
+                chat_id=12345,
+                text=f"📱 名片處理完成\n👤 名片 {i} (公司)\n",
+                priority=MessagePriority.BATCH,
+                message_type="card_processing_complete",
+            )
+
+        assert bulk_sender.await_count == 1
+        assert queue.queues[MessagePriority.HIGH].qsize() == 2
+
     # ==========================================
     # 4. 工作者和併發控制測試
     # ==========================================
@@ -341,7 +460,7 @@ class TestAsyncMessageQueue:
         # 啟動佇列
         await queue.start()
         assert queue.is_running is True
-        assert len(queue.workers) == queue.current_workers + 1  # +1 為監控任務
+        assert len(queue.workers) == 2  # 調度器 + 監控任務
 
         # 停止佇列
         await queue.stop()
@@ -369,6 +488,25 @@ class TestAsyncMessageQueue:
 
         await queue.stop()
 
+    async def test_idle_worker_wakes_on_enqueue(self, message_queue):
+        """測試閒置工作者在訊息入佇列後立即處理（無輪詢延遲）"""
+        queue, mock_sender = message_queue
+
+        await queue.start()
+        await asyncio.sleep(0.05)  # 讓工作者進入等待狀態
+
+        await queue.enqueue_message(
+            chat_id=12345, text="即時喚醒", priority=MessagePriority.NORMAL
+        )
+
+        # 遠小於舊版 0.1 秒輪詢間隔
+        await asyncio.sleep(0.02)
+
+        mock_sender.assert_called_with(12345, "即時喚醒", None)
+        assert queue.stats["current_queue_size"] == 0
+
+        await queue.stop()
+
     async def test_message_retry_mechanism(self, message_queue):
         """測試訊息重試機制"""
         queue, mock_sender = message_queue
@@ -404,6 +542,26 @@ class TestAsyncMessageQueue:
 
         await queue.stop()
 
+    async def test_retry_scheduled_as_timer(self, message_queue):
+        """測試失敗重試以計時器排程，到期後降級重新入隊"""
+        queue, mock_sender = message_queue
+        mock_sender.side_effect = Exception("模擬發送失敗")
+        queue.is_running = True
+
+        message = QueuedMessage(12345, "重試", MessagePriority.HIGH)
+        tasks_before = len(asyncio.all_tasks())
+        with patch.object(asyncio.get_running_loop(), "call_later") as mock_call_later:
+            await queue._process_message(message, "test")
+
+        assert len(asyncio.all_tasks()) == tasks_before
+        delay, callback, retried = mock_call_later.call_args[0]
+        assert delay == 2 and retried is message
+
+        callback(retried)
+        assert queue.queues[MessagePriority.NORMAL].qsize() == 1
+        assert queue.stats["current_queue_size"] == 1
+        queue.is_running = False
+
     async def test_priority_ordering(self, message_queue):
         """測試優先級排序處理"""
         queue, mock_sender = message_queue
@@ -464,6 +622,101 @@ class TestAsyncMessageQueue:
 
         await queue.stop()
 
+    async def test_concurrency_resize_wakes_waiting_slots(self, message_queue):
+        """測試調整併發上限時原地生效，等待中的工作者立即取得槽位"""
+        queue, mock_sender = message_queue
+        queue.current_workers = 2
+
+        entered = []
+        release = asyncio.Event()
+
+        async def hold_slot(i):
+            async with queue._worker_slot():
+                entered.append(i)
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold_slot(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert len(entered) == 2
+
+        # 低錯誤率且處理量足夠 → 上限 +1
+        queue.last_adjustment_time = float("-inf")
+        queue._total_processed = 1000
+        await queue._adjust_concurrency(0.0)
+        await asyncio.sleep(0.01)
+
+        assert queue.current_workers == 3
+        assert len(entered) == 3
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert queue.active_workers == 0
+
+    async def test_dispatcher_uses_raised_concurrency(self, message_queue):
+        """測試啟動後提高併發上限，調度器即可同時處理更多訊息"""
+        queue, mock_sender = message_queue
+        queue.current_workers = 1
+        await queue.start()
+
+        in_flight = []
+        release = asyncio.Event()
+
+        async def slow_sender(chat_id, text, parse_mode=None):
+            in_flight.append(text)
+            await release.wait()
+            return {"success": True}
+
+        queue.set_message_sender(slow_sender)
+        for i in range(3):
+            await queue.enqueue_message(
+                chat_id=12345, text=f"訊息 {i}", priority=MessagePriority.HIGH
+            )
+        await asyncio.sleep(0.05)
+        assert len(in_flight) == 1
+
+        queue.last_adjustment_time = float("-inf")
+        queue._total_processed = 1000
+        await queue._adjust_concurrency(0.0)
+        await queue._adjust_concurrency(0.0)  # 冷卻期內不重複調整
+        queue.last_adjustment_time = float("-inf")
+        await queue._adjust_concurrency(0.0)
+        await asyncio.sleep(0.05)
+
+        assert queue.current_workers == 3
+        assert len(in_flight) == 3
+
+        release.set()
+        await asyncio.sleep(0.05)
+        assert queue.stats["total_processed"] == 1003
+
+    async def test_stop_while_slots_busy(self, message_queue):
+        """測試槽位全被佔用時停止，調度器不必等槽位釋放即退出"""
+        queue, mock_sender = message_queue
+        queue.current_workers = 1
+        await queue.start()
+        dispatcher = queue.workers[0]
+
+        release = asyncio.Event()
+
+        async def slow_sender(chat_id, text, parse_mode=None):
+            await release.wait()
+            return {"success": True}
+
+        queue.set_message_sender(slow_sender)
+        for i in range(2):
+            await queue.enqueue_message(
+                chat_id=12345, text=f"訊息 {i}", priority=MessagePriority.HIGH
+            )
+        await asyncio.sleep(0.05)
+
+        stop_task = asyncio.create_task(queue.stop())
+        await asyncio.sleep(0.05)
+        assert dispatcher.done()
+
+        release.set()
+        await stop_task
+        assert queue.active_workers == 0
+
     async def test_performance_monitoring(self, message_queue):
         """測試效能監控"""
         queue, mock_sender = message_queue
@@ -487,6 +740,25 @@ class TestAsyncMessageQueue:
 
         await queue.stop()
 
+    def test_rolling_error_count(self, message_queue):
+        """測試錯誤數隨窗口淘汰同步更新"""
+        queue, mock_sender = message_queue
+
+        # 10 次失敗後接 20 次成功：失敗全部被淘汰
+        for _ in range(10):
+            queue._record_outcome(0.01, failed=True)
+        assert queue.recent_errors == 10
+
+        for _ in range(20):
+            queue._record_outcome(0.01, failed=False)
+        assert queue.recent_errors == 0
+        assert queue._get_queue_stats()["error_rate"] == 0
+
+        for _ in range(5):
+            queue._record_outcome(0.01, failed=True)
+        assert queue.recent_errors == sum(queue.error_rate_window) == 5
+        assert queue._get_queue_stats()["error_rate"] == 0.25
+
     # ==========================================
     # 6. 健康檢查和監控測試
     # ==========================================
@@ -589,6 +861,34 @@ class TestAsyncMessageQueue:
         # 檢查批次是否被清空
         assert len(queue.pending_batches) == 0
 
+    async def test_pending_batches_capped(self, message_queue):
+        """測試待合併批次達上限時，新 batch_key 的訊息直接進入普通佇列"""
+        queue, mock_sender = message_queue
+        queue.max_pending_batches = 2
+
+        for chat_id in (1, 2, 3):
+            await queue.enqueue_message(chat_id, "批次", MessagePriority.BATCH)
+        # 既有批次仍可繼續累積
+        await queue.enqueue_message(1, "批次", MessagePriority.BATCH)
+
+        assert len(queue.pending_batches) == 2
+        assert len(queue.pending_batches["1"]) == 2
+        assert queue.queues[MessagePriority.NORMAL].qsize() == 1
+        assert queue.stats["total_enqueued"] == 1
+
+    async def test_batch_context_flushes_only_its_own_batches(self, message_queue):
+        """測試批次上下文退出時只發送自己的批次"""
+        queue, mock_sender = message_queue
+
+        outer = BatchContext(queue, "outer")
+        await outer.send_message(chat_id=12345, text="外層訊息", message_type="t")
+
+        async with BatchContext(queue, "inner") as inner:
+            await inner.send_message(chat_id=12345, text="內層訊息", message_type="t")
+
+        assert "12345:t:inner" not in queue.pending_batches
+        assert len(queue.pending_batches["12345:t:outer"]) == 1
+
     # ==========================================
     # 8. 高負載和壓力測試
     # ==========================================
@@ -758,6 +1058,22 @@ async def test_message_deduplication():
     assert message1.message_id != message2.message_id
 
 
+def test_message_id_unique_for_same_timestamp():
+    """測試同一時間戳的相同內容訊息仍有不同ID"""
+    created_at = time.time()
+    ids = {
+        QueuedMessage(
+            chat_id=12345,
+            text="名片內容" * 1000,
+            priority=MessagePriority.NORMAL,
+            created_at=created_at,
+        ).message_id
+        for _ in range(100)
+    }
+
+    assert len(ids) == 100
+
+
 async def run_async_message_queue_integration_test():
     """運行異步訊息佇列整合測試"""
     print("🧪 開始異步訊息佇列整合測試...")
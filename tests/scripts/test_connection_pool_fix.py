@@ -142,10 +142,10 @@ class ConnectionPoolTester:
             shutdown_event = queue._get_shutdown_event()
             assert shutdown_event is not None
 
-            # 測試延遲創建的 worker_semaphore
-            worker_semaphore = queue._get_worker_semaphore()
-            assert worker_semaphore is not None
-            assert worker_semaphore._value == 3
+            # 測試延遲創建的 worker_condition
+            worker_condition = queue._get_worker_condition()
+            assert worker_condition is not None
+            assert queue.current_workers == 3
 
             # 測試在不同事件循環中重複獲取不會報錯
             def test_in_thread():
@@ -155,8 +155,8 @@ class ConnectionPoolTester:
                 async def inner_test():
                     # 這應該創建新的 event 而不是報錯
                     event = queue._get_shutdown_event()
-                    semaphore = queue._get_worker_semaphore()
-                    return event is not None and semaphore is not None
+                    condition = queue._get_worker_condition()
+                    return event is not None and condition is not None
 
                 return loop.run_until_complete(inner_test())
 
@@ -171,7 +171,7 @@ class ConnectionPoolTester:
                 "success": True,
                 "message": "✅ 異步訊息佇列事件循環綁定修復成功",
                 "shutdown_event_created": True,
-                "worker_semaphore_created": True,
+                "worker_condition_created": True,
                 "cross_eventloop_test": thread_result,
             }
 
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+ConnectionPoolManager 測試套件
+測試 session 復用、批次下載併發控制與統計
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from unittest.mock import MagicMock, patch
+
+import aiohttp
+import pytest
+
+from src.namecard.infrastructure.messaging.connection_pool_manager import (
+    ConnectionPoolConfig,
+    ConnectionPoolManager,
+)
+
+
+class TestConnectionPoolManager:
+    """連接池管理器測試類"""
+
+    @pytest.fixture
+    async def pool_manager(self):
+        """創建測試用的連接池管理器"""
+        manager = ConnectionPoolManager(ConnectionPoolConfig(retry_backoff=0.01))
+        yield manager
+        await manager.shutdown()
+
+    async def test_get_session_reuses_open_session(self, pool_manager):
+        """測試已建立的 session 直接復用，不重複建立"""
+        first = await pool_manager.get_session("default")
+        second = await pool_manager.get_session("default")
+
+        assert first is second
+        assert pool_manager.stats.total_created == 1
+
+    async def test_get_session_recreates_closed_session(self, pool_manager):
+        """測試已關閉的 session 會被重新建立"""
+        first = await pool_manager.get_session("default")
+        await first.close()
+
+        second = await pool_manager.get_session("default")
+
+        assert second is not first
+        assert not second.closed
+        assert pool_manager.stats.total_created == 2
+
+    async def test_connection_stats_counts_pooled_connections(self, pool_manager):
+        """測試連接統計加總各主機的閒置連接數"""
+        session = await pool_manager.get_session("default")
+        session.connector._conns = {
+            "host-a": [object(), object()],
+            "host-b": [object()],
+        }
+
+        stats = await pool_manager.get_connection_stats()
+
+        assert stats["total_sessions"] == 1
+        assert stats["session_details"]["default"]["active_connections"] == 3
+        session.connector._conns = {}
+
+    async def test_batch_download_bounded_window(self, pool_manager):
+        """測試批次下載同時進行的任務不超過併發度，結果依 URL 順序返回"""
+        in_flight = 0
+        peak = 0
+
+        async def fake_download(url, session_key="default"):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if url.endswith("3"):
+                raise RuntimeError("下載失敗")
+            return {"success": True, "url": url}
+
+        urls = [f"https://example.com/{i}" for i in range(10)]
+        with patch.object(pool_manager, "download_with_retry", fake_download):
+            results = await pool_manager.batch_download(urls, max_concurrent=3)
+
+        assert peak == 3
+        assert [r["url"] for r in results] == urls
+        assert results[3]["success"] is False
+        assert sum(r["success"] for r in results) == 9
+
+    async def test_batch_download_handles_cancelled_child(self, pool_manager):
+        """測試單一下載任務被取消時記錄為失敗，不中斷整個批次"""
+
+        async def fake_download(url, session_key="default"):
+            if url.endswith("1"):
+                raise asyncio.CancelledError()
+            return {"success": True, "url": url}
+
+        urls = [f"https://example.com/{i}" for i in range(3)]
+        with patch.object(pool_manager, "download_with_retry", fake_download):
+            results = await pool_manager.batch_download(urls)
+
+        assert [r["success"] for r in results] == [True, False, True]
+        assert results[1]["url"] == urls[1]
+
+    async def test_sessions_share_dns_resolver(self, pool_manager):
+        """測試不同 session 共用同一個 DNS 解析器"""
+        default = await pool_manager.get_session("default")
+        batch = await pool_manager.get_session("batch")
+
+        assert default.connector._resolver is batch.connector._resolver
+        assert default.connector._resolver is pool_manager._resolver
+
+    async def test_retry_backoff_uses_bounded_jitter(self, pool_manager):
+        """測試重試延遲帶抖動且不超過上限"""
+        pool_manager.config.retry_backoff = 1.0
+        pool_manager.config.max_backoff = 5.0
+
+        @asynccontextmanager
+        async def failing_request(url, session_key="default"):
+            raise aiohttp.ClientError("連線失敗")
+            yield
+
+        delays = []
+
+        async def record_sleep(delay):
+            delays.append(delay)
+
+        with patch.object(pool_manager, "request_context", failing_request):
+            with patch("asyncio.sleep", record_sleep):
+                result = await pool_manager.download_with_retry(
+                    "https://example.com/a", max_retries=6
+                )
+
+        assert result["success"] is False
+        assert len(delays) == 6
+        assert all(1.0 <= delay <= 5.0 for delay in delays)
+
+    async def test_retry_honours_retry_after_on_429(self, pool_manager):
+        """測試 429 回應依 Retry-After 等待，並受 max_backoff 上限約束"""
+        pool_manager.config.max_backoff = 5.0
+        headers = {"Retry-After": "2"}
+
+        @asynccontextmanager
+        async def rate_limited_request(url, session_key="default"):
+            yield MagicMock(status=429, headers=headers, history=())
+
+        delays = []
+
+        async def record_sleep(delay):
+            delays.append(delay)
+
+        with patch.object(pool_manager, "request_context", rate_limited_request):
+            with patch("asyncio.sleep", record_sleep):
+                result = await pool_manager.download_with_retry(
+                    "https://example.com/a", max_retries=1
+                )
+                headers["Retry-After"] = "120"
+                await pool_manager.download_with_retry(
+                    "https://example.com/b", max_retries=1
+                )
+
+        assert result["success"] is False
+        assert delays == [2.0, 5.0]
+
+    async def test_concurrent_first_calls_create_one_session(self, pool_manager):
+        """測試同一 key 併發首次取用時只建立一個 session"""
+        sessions = await asyncio.gather(
+            *(pool_manager.get_session("burst") for _ in range(5))
+        )
+
+        assert all(session is sessions[0] for session in sessions)
+        assert pool_manager.stats.total_created == 1
+        assert list(pool_manager._session_locks) == ["burst"]
+
+    async def test_failed_request_keeps_active_count(self, pool_manager):
+        """測試連線失敗的請求不會扣減其他請求的活躍連接數"""
+        pool_manager.stats.active_connections = 1
+        session = await pool_manager.get_session("default")
+
+        with patch.object(
+            session, "request", side_effect=aiohttp.ClientError("連線失敗")
+        ):
+            with pytest.raises(aiohttp.ClientError):
+                async with pool_manager.request_context("https://example.com/a"):
+                    pass
+
+        assert pool_manager.stats.active_connections == 1
+        assert pool_manager.stats.total_failed == 1
+        pool_manager.stats.active_connections = 0
+
+    async def test_batch_download_round_robins_shards(self, pool_manager):
+        """測試設定分片後批次下載輪流使用各分片 session"""
+        pool_manager.config.pool_shards = 2
+        used_keys = []
+
+        async def fake_download(url, session_key="default"):
+            used_keys.append(session_key)
+            return {"success": True, "url": url}
+
+        urls = [f"https://example.com/{i}" for i in range(4)]
+        with patch.object(pool_manager, "download_with_retry", fake_download):
+            await pool_manager.batch_download(urls, session_key="batch")
+
+        assert used_keys == ["batch_0", "batch_1", "batch_0", "batch_1"]
+
+    async def test_download_streams_body_in_chunks(self, pool_manager):
+        """測試下載以分塊方式讀取回應內容"""
+        chunks = [b"abc", b"def", b"g"]
+
+        async def iter_chunked(size):
+            for chunk in chunks:
+                yield chunk
+
+        response = MagicMock(status=200)
+        response.content.iter_chunked = iter_chunked
+
+        @asynccontextmanager
+        async def fake_request(url, session_key="default"):
+            yield response
+
+        with patch.object(pool_manager, "request_context", fake_request):
+            result = await pool_manager.download_with_retry("https://example.com/a")
+
+        assert result["success"] is True
+        assert result["data"] == b"abcdefg"
+        assert result["size"] == 7
+
+    async def test_batch_download_deduplicates_urls(self, pool_manager):
+        """測試批次中重複的 URL 只下載一次，結果仍依原順序返回"""
+        downloaded = []
+
+        async def fake_download(url, session_key="default"):
+            downloaded.append(url)
+            return {"success": True, "url": url, "data": bytearray(b"data")}
+
+        urls = ["https://example.com/a", "https://example.com/b"] * 2
+        with patch.object(pool_manager, "download_with_retry", fake_download):
+            results = await pool_manager.batch_download(urls)
+
+        assert downloaded == ["https://example.com/a", "https://example.com/b"]
+        assert [r["url"] for r in results] == urls
+        assert results[0] == results[2]
+        assert results[0] is not results[2]
+        assert isinstance(results[0]["data"], bytes)
+
+    async def test_concurrent_downloads_of_same_url_share_request(self, pool_manager):
+        """測試同一 URL 的併發下載只發出一次請求"""
+        requests = []
+        release = asyncio.Event()
+
+        response = MagicMock(status=200)
+
+        async def iter_chunked(size):
+            yield b"data"
+
+        response.content.iter_chunked = iter_chunked
+
+        @asynccontextmanager
+        async def fake_request(url, session_key="default"):
+            requests.append(url)
+            await release.wait()
+            yield response
+
+        with patch.object(pool_manager, "request_context", fake_request):
+            downloads = [
+                asyncio.create_task(
+                    pool_manager.download_with_retry("https://example.com/a")
+                )
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*downloads)
+
+        assert requests == ["https://example.com/a"]
+        assert all(result["data"] == b"data" for result in results)
+        # 各呼叫者的結果互不影響
+        assert results[0] is not results[1]
+        assert isinstance(results[0]["data"], bytes)
+        assert pool_manager._inflight_downloads == {}
+        assert pool_manager._download_waiters == {}
+
+    async def test_shared_download_keyed_by_session(self, pool_manager):
+        """測試同一 URL 但不同 session 的下載不共用請求"""
+        requests = []
+        response = MagicMock(status=200)
+
+        async def iter_chunked(size):
+            yield b"data"
+
+        response.content.iter_chunked = iter_chunked
+
+        @asynccontextmanager
+        async def fake_request(url, session_key="default"):
+            requests.append(session_key)
+            await asyncio.sleep(0.01)
+            yield response
+
+        with patch.object(pool_manager, "request_context", fake_request):
+            await asyncio.gather(
+                pool_manager.download_with_retry("https://example.com/a"),
+                pool_manager.download_with_retry(
+                    "https://example.com/a", session_key="batch"
+                ),
+            )
+
+        assert sorted(requests) == ["batch", "default"]
+
+    async def test_cancelling_all_waiters_cancels_download(self, pool_manager):
+        """測試所有等待者都被取消時，底層下載也隨之取消"""
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        @asynccontextmanager
+        async def hanging_request(url, session_key="default"):
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            yield
+
+        with patch.object(pool_manager, "request_context", hanging_request):
+            waiters = [
+                asyncio.create_task(
+                    pool_manager.download_with_retry("https://example.com/a")
+                )
+                for _ in range(2)
+            ]
+            await started.wait()
+
+            # 只取消一個等待者時下載繼續進行
+            waiters[0].cancel()
+            await asyncio.sleep(0.01)
+            assert not cancelled.is_set()
+
+            waiters[1].cancel()
+            await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+        assert pool_manager._inflight_downloads == {}
+        assert pool_manager._download_waiters == {}
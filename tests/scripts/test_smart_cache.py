@@ -9,6 +9,7 @@ import json
 import os
 import pickle
 import shutil
+import sqlite3
 import tempfile
 import time
 from datetime import datetime, timedelta
@@ -17,7 +18,12 @@ from unittest.mock import AsyncMock, MagicMock, patch
 import pytest
 
 # 導入測試目標
-from src.namecard.infrastructure.ai.smart_cache import CacheEntry, SmartCacheManager
+from src.namecard.infrastructure.ai import smart_cache
+from src.namecard.infrastructure.ai.smart_cache import (
+    CacheEntry,
+    ShardedMemoryCache,
+    SmartCacheManager,
+)
 
 
 class TestSmartCacheManager:
@@ -39,6 +45,7 @@ class TestSmartCacheManager:
         yield manager
 
         # 清理
+        await manager.close()
         shutil.rmtree(temp_dir, ignore_errors=True)
 
     @pytest.fixture
@@ -124,6 +131,88 @@ class TestSmartCacheManager:
         assert retrieved_value == value
         assert cache_manager.stats["disk_hits"] == 1
 
+    async def test_disk_cache_index_debounced_write(self, cache_manager, sample_data):
+        """測試磁碟索引延遲合併寫入 SQLite，並可由新實例載入"""
+        for i in range(3):
+            await cache_manager.set(
+                f"index_test_{i}", sample_data["large_data"], cache_level="disk"
+            )
+        await cache_manager._remove_from_disk("index_test_1")
+
+        # 多次變更只排程一個背景寫入任務
+        assert cache_manager._index_flush_task is not None
+        await asyncio.sleep(cache_manager._index_flush_delay + 0.2)
+        assert not cache_manager._index_dirty_keys
+
+        conn = sqlite3.connect(os.path.join(cache_manager.cache_dir, "index.db"))
+        try:
+            saved_keys = {row[0] for row in conn.execute("SELECT key FROM entries")}
+        finally:
+            conn.close()
+        assert saved_keys == {"index_test_0", "index_test_2"}
+
+        # 重新啟動後從索引資料庫載入
+        reloaded = SmartCacheManager(
+            max_memory_size_mb=1, max_disk_size_mb=5, cache_dir=cache_manager.cache_dir
+        )
+        await asyncio.sleep(0.1)
+        assert list(reloaded.disk_cache_index) == ["index_test_0", "index_test_2"]
+        assert await reloaded.get("index_test_2") == sample_data["large_data"]
+        await reloaded.close()
+
+    async def test_close_flushes_pending_index(self, cache_manager, sample_data):
+        """測試關閉時停止背景寫入任務，並寫入尚未儲存的索引變更"""
+        for i in range(2):
+            await cache_manager.set(
+                f"close_test_{i}", sample_data["large_data"], cache_level="disk"
+            )
+        await cache_manager._remove_from_disk("close_test_0")
+        flush_task = cache_manager._index_flush_task
+
+        await cache_manager.close()
+
+        assert flush_task.done()
+        assert cache_manager._index_db is None
+        assert not cache_manager._index_dirty_keys
+        assert cache_manager._disk_cache_bytes == sum(
+            info["size"] for info in cache_manager.disk_cache_index.values()
+        )
+        conn = sqlite3.connect(os.path.join(cache_manager.cache_dir, "index.db"))
+        try:
+            saved_keys = {row[0] for row in conn.execute("SELECT key FROM entries")}
+        finally:
+            conn.close()
+        assert saved_keys == {"close_test_1"}
+
+    async def test_legacy_json_index_import(self, sample_data):
+        """測試首次啟動時匯入舊版 JSON 索引"""
+        temp_dir = tempfile.mkdtemp(prefix="test_cache_")
+        try:
+            with open(os.path.join(temp_dir, "legacy.cache"), "wb") as f:
+                f.write(pickle.dumps(sample_data["small_data"]))
+            with open(os.path.join(temp_dir, "cache_index.json"), "w") as f:
+                json.dump(
+                    {
+                        "legacy_key": {
+                            "filename": "legacy.cache",
+                            "size": len(pickle.dumps(sample_data["small_data"])),
+                            "created_at": datetime.now().isoformat(),
+                            "ttl": 300,
+                        }
+                    },
+                    f,
+                )
+
+            manager = SmartCacheManager(cache_dir=temp_dir)
+            await asyncio.sleep(0.1)
+
+            assert "legacy_key" in manager.disk_cache_index
+            assert not os.path.exists(os.path.join(temp_dir, "cache_index.json"))
+            assert await manager.get("legacy_key") == sample_data["small_data"]
+            await manager.close()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
     # ==========================================
     # 2. 快取命中率測試
     # ==========================================
@@ -154,6 +243,182 @@ class TestSmartCacheManager:
         expected_hit_rate = (1 + 1) / 2 * 100  # 100%
         assert stats["performance"]["hit_rate_percentage"] == expected_hit_rate
 
+    async def test_redis_client_side_cache(self, cache_manager):
+        """測試 Redis 客戶端快取：重複命中免網路往返，失效通知後重新讀取"""
+        key = "card_processing:abc:def"
+        value = {"data": "x" * 1024 * 200}  # 超過記憶體提升門檻
+
+        cache_manager.redis_client = AsyncMock()
+        cache_manager.redis_client.get.return_value = pickle.dumps(value)
+        cache_manager._redis_tracking_active = True
+
+        assert await cache_manager.get(key) == value
+        assert await cache_manager.get(key) == value
+        assert cache_manager.redis_client.get.await_count == 1
+        assert cache_manager.stats["redis_hits"] == 2
+
+        # 伺服器端失效通知
+        cache_manager._invalidate_redis_near_cache([key.encode()])
+        assert await cache_manager.get(key) == value
+        assert cache_manager.redis_client.get.await_count == 2
+
+    async def test_redis_near_cache_bounds(self, cache_manager):
+        """測試 Redis 客戶端快取受位元組上限與存活時間約束"""
+        cache_manager._redis_tracking_active = True
+        epoch = cache_manager._redis_invalidation_epoch
+
+        with patch.object(smart_cache, "REDIS_NEAR_CACHE_MAX_BYTES", 100):
+            cache_manager._remember_redis_value("card_processing:a", "a", 60, epoch)
+            cache_manager._remember_redis_value("card_processing:b", "b", 60, epoch)
+            cache_manager._remember_redis_value("card_processing:c", "c", 200, epoch)
+
+        # 超過上限時淘汰最舊的副本，單一過大的值不保存
+        assert list(cache_manager._redis_near_cache) == ["card_processing:b"]
+        assert cache_manager._redis_near_cache_bytes == 60
+
+        # 過期的副本不再命中，改回 Redis 讀取
+        cache_manager.redis_client = AsyncMock()
+        cache_manager.redis_client.get.return_value = None
+        with patch.object(smart_cache, "REDIS_NEAR_CACHE_TTL", -1):
+            cache_manager._remember_redis_value("card_processing:d", "d", 10, epoch)
+        assert await cache_manager.get("card_processing:d") is None
+        assert cache_manager.redis_client.get.await_count == 1
+        assert "card_processing:d" not in cache_manager._redis_near_cache
+
+    async def test_redis_tracking_reconnect_resets_near_cache(self, cache_manager):
+        """測試失效通知連接重連後清空本地副本、以新的 CLIENT ID 重新啟用追蹤，並於關閉時釋放連接"""
+        reconnected = asyncio.Event()
+        stop = asyncio.Event()
+        pubsubs = []
+        tracking_calls = []
+
+        class FakePubSub:
+            def __init__(self):
+                self.connection = MagicMock()
+                self.connection.send_command = AsyncMock()
+                self.connection.read_response = AsyncMock(return_value=len(pubsubs))
+                self.connect = AsyncMock()
+                self.subscribe = AsyncMock()
+                self.aclose = AsyncMock()
+                pubsubs.append(self)
+
+            async def listen(self):
+                yield {"type": "subscribe", "data": 1}
+                if len(pubsubs) == 1:
+                    await reconnected.wait()
+                    # 重連後 redis-py 自動重新訂閱
+                    yield {"type": "subscribe", "data": 1}
+                await stop.wait()
+
+        tracking_client = MagicMock()
+        tracking_client.aclose = AsyncMock()
+
+        async def client_tracking_on(clientid, bcast, prefix):
+            tracking_calls.append(clientid)
+
+        tracking_client.client_tracking_on = client_tracking_on
+        cache_manager.redis_client = MagicMock()
+        cache_manager.redis_client.pubsub = FakePubSub
+        cache_manager.redis_client.client.return_value = tracking_client
+
+        cache_manager._redis_tracking_task = asyncio.create_task(
+            cache_manager._start_redis_tracking()
+        )
+        await asyncio.sleep(0.01)
+        assert cache_manager._redis_tracking_active
+        epoch = cache_manager._redis_invalidation_epoch
+        cache_manager._remember_redis_value("card_processing:a", "a", 10, epoch)
+
+        reconnected.set()
+        await asyncio.sleep(0.01)
+
+        assert cache_manager._redis_near_cache_bytes == 0
+        assert not cache_manager._redis_near_cache
+        assert tracking_calls == [0, 1]
+        assert cache_manager._redis_tracking_active
+        pubsubs[0].aclose.assert_awaited()
+
+        await cache_manager.close()
+        assert not cache_manager._redis_tracking_active
+        pubsubs[1].aclose.assert_awaited()
+        assert tracking_client.aclose.await_count == 2
+
+    async def test_get_or_compute_single_flight(self, cache_manager, sample_data):
+        """測試並發未命中只觸發一次計算"""
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return sample_data["small_data"]
+
+        results = await asyncio.gather(
+            *(cache_manager.get_or_compute("single_flight", compute) for _ in range(10))
+        )
+
+        assert calls == 1
+        assert all(result == sample_data["small_data"] for result in results)
+        assert "single_flight" in cache_manager.memory_cache
+        assert not cache_manager._inflight
+
+        # 計算失敗時所有等待者都收到例外，且不留下進行中的紀錄
+        async def failing_compute():
+            await asyncio.sleep(0.01)
+            raise ValueError("AI 處理失敗")
+
+        results = await asyncio.gather(
+            *(
+                cache_manager.get_or_compute("failing", failing_compute)
+                for _ in range(3)
+            ),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+        assert not cache_manager._inflight
+
+    async def test_get_or_compute_survives_owner_cancel(
+        self, cache_manager, sample_data
+    ):
+        """測試發起計算的呼叫者被取消時，其他等待者仍取得結果；全部離開才取消計算"""
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return sample_data["small_data"]
+
+        owner = asyncio.create_task(cache_manager.get_or_compute("owner", compute))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache_manager.get_or_compute("owner", compute))
+        await asyncio.sleep(0.01)
+
+        owner.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+
+        assert await waiter == sample_data["small_data"]
+        assert owner.cancelled()
+        assert not cache_manager._inflight
+        assert not cache_manager._inflight_waiters
+
+        # 所有呼叫者都離開時，計算任務隨之取消
+        cancelled = asyncio.Event()
+
+        async def hanging_compute():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.create_task(
+            cache_manager.get_or_compute("abandoned", hanging_compute)
+        )
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        assert not cache_manager._inflight
+
     async def test_cache_miss_handling(self, cache_manager):
         """測試快取未命中處理"""
         # 嘗試獲取不存在的鍵值
@@ -190,10 +455,26 @@ class TestSmartCacheManager:
         first_key = keys[0]
         assert first_key not in cache_manager.memory_cache
 
+    async def test_memory_scan_resistance(self, cache_manager):
+        """測試 S3-FIFO：一次性掃描不會擠掉被重複存取的熱門項目"""
+        value = {"data": "x" * 1024 * 20}  # ~20KB
+
+        await cache_manager.set("hot_key", value, cache_level="memory")
+        await cache_manager.get("hot_key")
+
+        # 掃描寫入遠超記憶體容量的一次性項目
+        for i in range(100):
+            await cache_manager.set(f"scan_{i}", value, cache_level="memory")
+
+        assert "hot_key" in cache_manager.memory_cache
+        assert "scan_0" not in cache_manager.memory_cache
+        assert cache_manager.memory_cache.size <= cache_manager.max_memory_size
+
     async def test_disk_capacity_management(self, cache_manager):
         """測試磁碟容量管理"""
         # 創建超過磁碟限制的數據（5MB 限制）
-        huge_value = {"data": "x" * 1024 * 1024}  # 1MB 每個
+        # 使用隨機資料，避免磁碟壓縮讓容量限制失效
+        huge_value = {"data": os.urandom(1024 * 1024)}  # 1MB 每個
 
         keys = []
         for i in range(7):  # 7MB > 5MB 限制
@@ -210,6 +491,15 @@ class TestSmartCacheManager:
         # 檢查最舊的檔案被移除
         assert len(cache_manager.disk_cache_index) < 7
 
+    async def test_disk_capacity_uses_compressed_size(self, cache_manager):
+        """測試磁碟容量以壓縮後大小計算，可壓縮的資料不會被提早淘汰"""
+        value = {"data": "x" * 1024 * 1024 * 6}  # 未壓縮 6MB > 5MB 限制
+
+        for i in range(3):
+            await cache_manager.set(f"compressible_{i}", value, cache_level="disk")
+
+        assert len(cache_manager.disk_cache_index) == 3
+
     # ==========================================
     # 4. 過期機制測試
     # ==========================================
@@ -281,6 +571,40 @@ class TestSmartCacheManager:
         await cache_manager.set("large", sample_data["huge_data"], cache_level="auto")
         assert "large" in cache_manager.disk_cache_index
 
+    async def test_auto_cache_write_through(self, cache_manager, sample_data):
+        """測試自動層級一次決定所有寫入目標：小資料同時寫穿到 Redis"""
+        cache_manager.redis_client = AsyncMock()
+
+        await cache_manager.set("small", sample_data["small_data"], ttl_seconds=60)
+        assert "small" in cache_manager.memory_cache
+        cache_manager.redis_client.set.assert_awaited_once_with(
+            "small", pickle.dumps(sample_data["small_data"]), ex=60, nx=False
+        )
+
+        # 沒有 Redis 時，中型資料改存磁碟而非直接捨棄
+        cache_manager.redis_client = None
+        medium_value = {"data": "x" * 1024 * 100}
+        await cache_manager.set("medium_no_redis", medium_value)
+        assert "medium_no_redis" in cache_manager.disk_cache_index
+
+    async def test_auto_cache_serializes_large_values_off_loop(
+        self, cache_manager, sample_data
+    ):
+        """測試自動層級只有預估為大型的值才移到執行緒序列化，小型值留在事件循環"""
+        offloaded = []
+        to_thread = asyncio.to_thread
+
+        async def record_to_thread(func, *args):
+            offloaded.append(func)
+            return await to_thread(func, *args)
+
+        with patch.object(smart_cache.asyncio, "to_thread", record_to_thread):
+            await cache_manager.set("small", sample_data["small_data"])
+            assert pickle.dumps not in offloaded
+
+            await cache_manager.set("huge", sample_data["huge_data"])
+            assert pickle.dumps in offloaded
+
     async def test_cache_key_generation(self, cache_manager):
         """測試快取鍵值生成"""
         image_data = b"fake_image_bytes"
@@ -363,10 +687,48 @@ class TestSmartCacheManager:
         assert capacity["memory"]["entries"] >= 1  # 至少保留一個項目 (取決於淘汰策略)
         assert capacity["disk"]["entries"] == 1
 
+    async def test_cache_statistics_memoized(self, cache_manager):
+        """測試快取統計在短時間內重複使用"""
+        stats1 = await cache_manager.get_cache_stats()
+        stats1["performance"]["total_requests"] = 999  # 呼叫端修改不影響快取
+
+        await cache_manager.get("non_existent")
+        stats2 = await cache_manager.get_cache_stats()
+        assert stats2["performance"]["total_requests"] == 0
+
+        # 過期後重新計算
+        with patch("src.namecard.infrastructure.ai.smart_cache.STATS_CACHE_TTL", 0):
+            stats3 = await cache_manager.get_cache_stats()
+        assert stats3["performance"]["total_requests"] == 1
+
     # ==========================================
     # 7. 錯誤處理和邊界測試
     # ==========================================
 
+    @pytest.mark.skipif(smart_cache.zstd is None, reason="需要 zstandard")
+    async def test_disk_cache_compression(self, cache_manager, sample_data):
+        """測試磁碟快取壓縮與舊格式（未壓縮）相容"""
+        key = "compressed_key"
+        value = sample_data["huge_data"]
+        await cache_manager.set(key, value, cache_level="disk")
+
+        file_info = cache_manager.disk_cache_index[key]
+        assert file_info["compressed"] is True
+        assert file_info["size"] < len(pickle.dumps(value))
+        assert await cache_manager.get(key) == value
+
+        # 舊索引項目沒有 compressed 欄位，直接反序列化
+        legacy_filename = "legacy_file.cache"
+        with open(os.path.join(cache_manager.cache_dir, legacy_filename), "wb") as f:
+            f.write(pickle.dumps(value))
+        cache_manager.disk_cache_index["legacy_key"] = {
+            "filename": legacy_filename,
+            "size": len(pickle.dumps(value)),
+            "created_at": datetime.now().isoformat(),
+            "ttl": 300,
+        }
+        assert await cache_manager.get("legacy_key") == value
+
     async def test_corrupted_disk_cache_handling(self, cache_manager):
         """測試損壞磁碟快取處理"""
         # 手動創建損壞的快取檔案
@@ -390,6 +752,19 @@ class TestSmartCacheManager:
         assert result is None
         assert cache_manager.stats["misses"] == 1
 
+    async def test_missing_disk_file_handling(self, cache_manager, sample_data):
+        """測試磁碟檔案被外部刪除時同步移除索引"""
+        key = "missing_file_key"
+        await cache_manager.set(key, sample_data["large_data"], cache_level="disk")
+
+        file_info = cache_manager.disk_cache_index[key]
+        os.remove(os.path.join(cache_manager.cache_dir, file_info["filename"]))
+
+        result = await cache_manager.get(key)
+        assert result is None
+        assert key not in cache_manager.disk_cache_index
+        assert cache_manager.stats["misses"] == 1
+
     async def test_concurrent_access(self, cache_manager, sample_data):
         """測試並發存取安全性"""
 
@@ -484,11 +859,12 @@ class TestSmartCacheManager:
 
 async def test_cache_entry_basic_functionality():
     """測試 CacheEntry 基本功能"""
+    now = time.monotonic()
     entry = CacheEntry(
         key="test",
         value={"data": "test"},
-        created_at=datetime.now(),
-        last_accessed=datetime.now(),
+        created_at=now,
+        last_accessed=now,
         access_count=1,
         size_bytes=100,
         ttl_seconds=60,
@@ -504,8 +880,8 @@ async def test_cache_entry_basic_functionality():
     old_entry = CacheEntry(
         key="old",
         value={"data": "old"},
-        created_at=datetime.now() - timedelta(seconds=120),
-        last_accessed=datetime.now() - timedelta(seconds=120),
+        created_at=now - 120,
+        last_accessed=now - 120,
         access_count=1,
         size_bytes=100,
         ttl_seconds=60,  # 已過期
@@ -515,6 +891,28 @@ async def test_cache_entry_basic_functionality():
     assert old_entry.should_evict(max_idle_time=60)
 
 
+async def test_sharded_memory_cache_layout():
+    """測試記憶體快取分片數依容量調整"""
+    small_cache = ShardedMemoryCache(1024 * 1024)
+    assert len(small_cache.shards) == 1
+
+    large_cache = ShardedMemoryCache(100 * 1024 * 1024)
+    assert len(large_cache.shards) == ShardedMemoryCache.MAX_SHARDS
+    assert all(
+        shard.max_size == 100 * 1024 * 1024 // ShardedMemoryCache.MAX_SHARDS
+        for shard in large_cache.shards
+    )
+
+    now = time.monotonic()
+    for i in range(50):
+        large_cache.shard_for(f"key_{i}").put(
+            CacheEntry(f"key_{i}", i, now, now, 1, 10, 60)
+        )
+    assert len(large_cache) == 50
+    assert large_cache["key_7"].value == 7
+    assert large_cache.size == 500
+
+
 async def run_cache_integration_test():
     """運行完整的快取整合測試"""
     print("🧪 開始智能快取系統整合測試...")